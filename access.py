@@ -0,0 +1,171 @@
+"""
+Sampled read counting for models with an access_count field
+
+Reads are sampled, counted in memory, and added to access_count in bulk
+every ACCESS_FLUSH_INTERVAL seconds, with one UPDATE per distinct
+increment rather than a write per read.  Flushes run in a thread of their
+own, in their own transaction, so reads never wait on them or get caught
+up in their locks; whatever is pending is flushed at exit.  Counts are
+estimates: each sampled read counts for 1 / ACCESS_SAMPLE_RATE reads.
+
+warm_cache() uses the counts to preload the most read models into the
+model cache, e.g. at deploy or startup.
+
+"""
+# stdlib imports
+import atexit
+import random
+import threading
+import time
+# django imports
+from django.db import connections, router, transaction
+from django.db.models import F
+# local imports
+from bserial.settings import (ACCESS_SAMPLE_RATE, ACCESS_FLUSH_INTERVAL,
+                              ACCESS_MAX_PENDING)
+
+
+
+
+class AccessTracker(object):
+    """
+    Thread safe sampled access counter for one model
+
+    Arguments:
+    ----------
+    0   model           model class with an access_count field
+    1   sample_rate     fraction of reads counted
+    2   interval        seconds between flushes
+    3   max_pending     most distinct pks counted before flushing early
+    4   background      flush from a thread of its own rather than the
+                        reading one
+
+    """
+    def __init__(self, model, sample_rate=ACCESS_SAMPLE_RATE,
+                 interval=ACCESS_FLUSH_INTERVAL,
+                 max_pending=ACCESS_MAX_PENDING, background=True,
+                 clock=time.time, random=random.random):
+        self.model = model
+        self.sample_rate = sample_rate
+        self.interval = interval
+        self.max_pending = max_pending
+        self.background = background
+        self.clock = clock
+        self.random = random
+        self.pending = {}
+        self.flushed_at = clock()
+        self.lock = threading.Lock()
+        self.flusher = None
+
+
+    def record(self, pks):
+        """count a read of each of pks, flushing if it is time to"""
+        if not self.sample_rate:
+            return
+        weight = int(round(1 / self.sample_rate))
+        sampled = [pk for pk in pks
+                   if pk is not None and self.random() < self.sample_rate]
+        with self.lock:
+            for pk in sampled:
+                self.pending[pk] = self.pending.get(pk, 0) + weight
+            due = (len(self.pending) >= self.max_pending or
+                   self.clock() - self.flushed_at >= self.interval)
+            if due and self.background:
+                if self.flusher is not None and self.flusher.is_alive():
+                    # already flushing; these counts go in the next one
+                    return
+                # started under the lock, so no other reader can see it
+                # before it is alive
+                self.flusher = threading.Thread(target=self._flush_thread)
+                self.flusher.start()
+                return
+        if due:
+            self.flush()
+
+
+    def _flush_thread(self):
+        """flush, then close the connection this thread opened"""
+        try:
+            self.flush()
+        finally:
+            connections[router.db_for_write(self.model)].close()
+
+
+    def flush(self):
+        """
+        add pending counts to access_count, one UPDATE per increment, in a
+        transaction of their own
+
+        """
+        with self.lock:
+            pending, self.pending = self.pending, {}
+            self.flushed_at = self.clock()
+        if not pending:
+            return 0
+        by_count = {}
+        for pk, count in pending.items():
+            by_count.setdefault(count, []).append(pk)
+        manager = self.model._default_manager
+        using = router.db_for_write(self.model)
+        with transaction.commit_on_success(using=using):
+            for count, pks in by_count.items():
+                for i in xrange(0, len(pks), 500):
+                    manager.using(using).filter(pk__in=pks[i:i + 500]).update(
+                            access_count=F("access_count") + count)
+        return len(pending)
+
+
+
+
+# trackers by model; None for models without an access_count field
+_trackers = {}
+_trackers_lock = threading.Lock()
+
+
+def get_tracker(model):
+    """Return the AccessTracker of model, or None if it isn't tracked"""
+    try:
+        return _trackers[model]
+    except KeyError:
+        pass
+    opts = model._meta
+    opts = getattr(opts, "concrete_model", model)._meta
+    tracked = ACCESS_SAMPLE_RATE and "access_count" in [
+            field.name for field in opts.fields]
+    with _trackers_lock:
+        if model not in _trackers:
+            _trackers[model] = AccessTracker(model) if tracked else None
+        return _trackers[model]
+
+
+def set_tracker(model, tracker):
+    """Replace the AccessTracker of model, returning the previous one"""
+    with _trackers_lock:
+        old = _trackers.get(model)
+        _trackers[model] = tracker
+    return old
+
+
+def flush_all():
+    """flush every tracker; registered to run at exit"""
+    for tracker in list(_trackers.values()):
+        if tracker is not None:
+            tracker.flush()
+
+atexit.register(flush_all)
+
+
+def warm_cache(count=1000, model=None, chunk_size=100):
+    """
+    Load the count most read models into the model cache, merged with any
+    attributes already cached.  Returns the number of models loaded.
+
+    """
+    if model is None:
+        # deferred import because bserial.models uses bserial.query
+        from bserial.models import Book as model
+    qs = model.objects.get_query_set().untracked()
+    objs = list(qs.order_by("-access_count", "pk")[:count])
+    for i in xrange(0, len(objs), chunk_size):
+        qs.cache_add_many(objs[i:i + chunk_size])
+    return len(objs)
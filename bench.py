@@ -0,0 +1,163 @@
+"""
+Micro benchmarks for BreakfastSerial hot paths
+
+Run from a configured django shell:
+
+    >>> from bserial import bench
+    >>> bench.run()
+
+"""
+# stdlib imports
+import cPickle as pickle
+import os
+import urllib2
+from copy import deepcopy
+from urlparse import urlsplit
+from timeit import default_timer
+from xml.dom.minidom import parseString
+# django imports
+from django.core.cache import get_cache
+# 3rd party imports
+import xpath
+# local imports
+from bserial.client import AmazonClient
+from bserial.models import Book
+from bserial.standin import StandInServer
+from bserial.util import merge_objects, pack_object, unpack_object
+from bserial.serial import AmazonBookInterface, DictMapping, compile_selector
+
+
+TESTDATA = os.path.join(os.path.dirname(__file__), "testdata")
+
+
+def recorded_response(name="item_lookup.xml"):
+    """return the raw xml of a recorded amazon response"""
+    with open(os.path.join(TESTDATA, name)) as f:
+        return f.read()
+
+
+def _time(fn, number):
+    """return seconds per call of fn, averaged over number calls"""
+    start = default_timer()
+    for i in xrange(number):
+        fn()
+    return (default_timer() - start) / number
+
+
+def _report(name, before, after):
+    print("%-24s before: %9.1fus  after: %9.1fus  (x%.1f)" % (
+            name, before * 1e6, after * 1e6, before / after))
+
+
+def _selectors(mapping):
+    """list every selector string evaluated by mapping"""
+    if isinstance(mapping, DictMapping):
+        out = _selectors(mapping.item_root)
+        for sub in mapping.attr_dict.values():
+            out += _selectors(sub)
+        return out
+    return [mapping.selector]
+
+
+def bench_xpath_plans(number=200):
+    """per-item cost of raw selector strings vs compiled xpath plans"""
+    interface = AmazonBookInterface()
+    doc = parseString(recorded_response())
+    items = interface.item_root.parse(doc)
+    mappings = interface.get_maps().values()
+
+    selectors = sum([_selectors(m) for m in mappings], [])
+    plans = [compile_selector(selector, "minidom") for selector in selectors]
+
+    def before():
+        for item in items:
+            for selector in selectors:
+                xpath.find(selector, item)
+
+    def after():
+        for item in items:
+            for plan in plans:
+                plan.find(item)
+
+    _report("xpath plans (per item)",
+            _time(before, number) / len(items),
+            _time(after, number) / len(items))
+
+
+def _deepcopy_merge(*args):
+    """merge_objects as it was, deep copying the first object"""
+    tgt = deepcopy(args[0])
+    for src in args[1:]:
+        for property in src.__dict__:
+            if (not callable(src.__dict__[property]) and
+                    not hasattr(tgt, property)):
+                setattr(tgt, property, getattr(src, property))
+    return tgt
+
+
+def bench_merge(number=10000):
+    """per-merge cost of merging a cached book into a fresh one"""
+    image = {"url": "http://example.com/cover.jpg", "height": "75",
+             "height_units": "pixels", "width": "49", "width_units": "pixels"}
+    book = Book(pk=1, asin="B000FC1PJI", title="Breakfast of Champions",
+                author="Kurt Vonnegut", description="A novel." * 50)
+    cached = Book(pk=1, asin="B000FC1PJI")
+    cached.small_image = image
+    cached.medium_image = dict(image)
+    cached.large_image = dict(image)
+
+    _report("merge_objects",
+            _time(lambda: _deepcopy_merge(book, cached), number),
+            _time(lambda: merge_objects(book, cached), number))
+
+
+def bench_client(number=500):
+    """requests/sec against a local stand-in, per-request vs pooled"""
+    server = StandInServer().start()
+    try:
+        client = AmazonClient("key", "secret", "tag", server.url)
+
+        def before():
+            # what bottlenose does: sign, then urlopen on a new connection
+            url = client.amazon.ItemLookup.api_url(ItemId="B000FC1PJI")
+            parts = urlsplit(url)
+            urllib2.urlopen("%s%s?%s" % (server.url, parts.path,
+                                         parts.query)).read()
+
+        def after():
+            client.ItemLookup(ItemId="B000FC1PJI")
+
+        before_time = _time(before, number)
+        after_time = _time(after, number)
+        print("%-24s before: %9.1f/s  after: %9.1f/s  (x%.1f)" % (
+                "amazon requests", 1 / before_time, 1 / after_time,
+                before_time / after_time))
+    finally:
+        server.stop()
+
+
+def bench_cache_payload(number=10000):
+    """size and cache get latency of pickled vs packed books"""
+    cache = get_cache("django.core.cache.backends.locmem.LocMemCache")
+    interface = AmazonBookInterface()
+    item = interface.item_root.parse(
+            interface.parse_string(recorded_response()))[0]
+    book = Book(pk=1)
+    book.__dict__.update(interface.parse_attrs(item))
+    pickled = pickle.dumps(book, pickle.HIGHEST_PROTOCOL)
+    packed = pack_object(book)
+    print("%-24s before: %9d B   after: %9d B   (x%.1f)" % (
+            "cached book size", len(pickled), len(packed),
+            float(len(pickled)) / len(packed)))
+    cache.set("pickled", book)
+    cache.set("packed", packed)
+    _report("cached book get",
+            _time(lambda: cache.get("pickled"), number),
+            _time(lambda: unpack_object(cache.get("packed"), Book), number))
+
+
+def run():
+    bench_xpath_plans()
+    bench_merge()
+    bench_client()
+    bench_cache_payload()
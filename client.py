@@ -0,0 +1,163 @@
+"""
+Shared amazon api clients with pooled keep-alive connections
+
+bottlenose signs requests, but opens a new connection with urllib2 for each
+one.  AmazonClient keeps bottlenose's request signing and sends requests
+over a pool of persistent http connections instead.  get_client() returns
+one client per set of credentials for the whole process.
+
+"""
+# stdlib imports
+import gzip
+import httplib
+import socket
+import threading
+from functools import partial
+from StringIO import StringIO
+from urllib2 import HTTPError
+from urlparse import urlsplit
+# 3rd party imports
+from bottlenose import Amazon
+# local imports
+from bserial.settings import (AMAZON_ACCESS_KEY_ID, AMAZON_SECRET_KEY,
+                              AMAZON_ASSOC_TAG, AMAZON_ENDPOINT,
+                              AMAZON_POOL_SIZE, AMAZON_TIMEOUT)
+
+
+
+
+class ConnectionPool(object):
+    """
+    Thread safe pool of keep-alive http connections to one host
+
+    At most size idle connections are kept; connections beyond that are
+    closed after use.
+
+    """
+    def __init__(self, scheme, netloc, size=AMAZON_POOL_SIZE,
+                 timeout=AMAZON_TIMEOUT):
+        if scheme == "https":
+            self.connection_class = httplib.HTTPSConnection
+        else:
+            self.connection_class = httplib.HTTPConnection
+        self.netloc = netloc
+        self.size = size
+        self.timeout = timeout
+        self.idle = []
+        self.lock = threading.Lock()
+        # connections opened, for monitoring reuse
+        self.opened = 0
+
+
+    def _get(self):
+        with self.lock:
+            if self.idle:
+                return self.idle.pop(), True
+            self.opened += 1
+        if self.timeout:
+            return self.connection_class(self.netloc,
+                                         timeout=self.timeout), False
+        return self.connection_class(self.netloc), False
+
+
+    def _put(self, conn):
+        with self.lock:
+            if len(self.idle) < self.size:
+                self.idle.append(conn)
+                return
+        conn.close()
+
+
+    def request(self, path, headers=None):
+        """
+        Send a GET request for path, returning the fully read response and
+        its body.
+
+        A request that fails on a reused connection (which the server may
+        have closed while it sat idle) is retried once on a new one.
+
+        """
+        conn, reused = self._get()
+        try:
+            conn.request("GET", path, headers=headers or {})
+            response = conn.getresponse()
+            body = response.read()
+        except (httplib.HTTPException, socket.error):
+            conn.close()
+            if not reused:
+                raise
+            return self.request(path, headers)
+        if response.will_close:
+            conn.close()
+        else:
+            self._put(conn)
+        return response, body
+
+
+
+
+class AmazonClient(object):
+    """
+    Thread safe amazon api client
+
+    Operations are called like bottlenose's (client.ItemLookup(**kwargs))
+    and return the raw xml response.  Requests go to endpoint (scheme and
+    host, e.g. "http://localhost:8000") instead of amazon if given.
+
+    """
+    def __init__(self, access_key, secret_key, assoc_tag, endpoint=None):
+        self.amazon = Amazon(access_key, secret_key, assoc_tag)
+        self.endpoint = urlsplit(endpoint) if endpoint else None
+        self.pools = {}
+        self.lock = threading.Lock()
+
+
+    def __getattr__(self, operation):
+        if operation.startswith("_"):
+            raise AttributeError(operation)
+        return partial(self.call, operation)
+
+
+    def _pool(self, scheme, netloc):
+        try:
+            return self.pools[scheme, netloc]
+        except KeyError:
+            with self.lock:
+                return self.pools.setdefault((scheme, netloc),
+                                             ConnectionPool(scheme, netloc))
+
+
+    def call(self, operation, **kwargs):
+        """send a signed request for operation, returning the response xml"""
+        url = getattr(self.amazon, operation).api_url(**kwargs)
+        scheme, netloc, path, query, fragment = urlsplit(url)
+        if self.endpoint:
+            scheme, netloc = self.endpoint.scheme, self.endpoint.netloc
+        response, body = self._pool(scheme, netloc).request(
+                "%s?%s" % (path, query), {"Accept-Encoding": "gzip"})
+        if response.status >= 400:
+            raise HTTPError(url, response.status, response.reason,
+                            response.msg, StringIO(body))
+        if "gzip" in (response.getheader("Content-Encoding") or ""):
+            body = gzip.GzipFile(fileobj=StringIO(body)).read()
+        return body
+
+
+
+
+# clients by credentials and endpoint
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def get_client(access_key=AMAZON_ACCESS_KEY_ID, secret_key=AMAZON_SECRET_KEY,
+               assoc_tag=AMAZON_ASSOC_TAG, endpoint=AMAZON_ENDPOINT):
+    """Return the process wide AmazonClient for a set of credentials"""
+    key = (access_key, secret_key, assoc_tag, endpoint)
+    try:
+        return _clients[key]
+    except KeyError:
+        with _clients_lock:
+            if key not in _clients:
+                _clients[key] = AmazonClient(*key)
+            return _clients[key]
@@ -0,0 +1,270 @@
+"""
+XML parsing engines for XMLInterface
+
+An engine turns raw xml into a document and compiles selectors into plans
+that can be evaluated against the nodes of that document.  Plans expose the
+same find/findnode/findvalue methods as xpath.XPath, so XMLMappings work the
+same way regardless of the engine that produced the node.
+
+MinidomEngine (xml.dom.minidom + the pure python xpath package) is always
+available.  LxmlEngine runs the same selectors on libxml2 when lxml is
+installed.
+
+"""
+# stdlib imports
+import re
+import threading
+from xml.dom import pulldom
+from xml.dom.minidom import parseString
+from xml.dom import Node
+# 3rd party imports
+import xpath
+try:
+    from lxml import etree
+except ImportError:
+    etree = None
+# local imports
+from bserial.settings import XML_ENGINE
+
+
+
+
+class MinidomEngine(object):
+    """parse with xml.dom.minidom, select with the xpath package"""
+    name = "minidom"
+    node_types = (Node,)
+
+    def __init__(self):
+        self._plans = {}
+
+    def parse_string(self, text):
+        return parseString(text)
+
+    def iterparse(self, stream, steps):
+        """
+        yield each element of stream whose path matches steps, fully built,
+        as soon as it closes.  Yielded subtrees are unlinked once the
+        consumer moves on.
+
+        """
+        path = []
+        events = pulldom.parse(stream)
+        for event, node in events:
+            if event == pulldom.START_ELEMENT:
+                path.append(node.localName)
+                if match_path(path, steps):
+                    # build the subtree, consuming its END_ELEMENT
+                    events.expandNode(node)
+                    path.pop()
+                    yield node
+                    node.unlink()
+            elif event == pulldom.END_ELEMENT:
+                path.pop()
+
+    def compile(self, selector):
+        """return compiled plan for selector, cached per selector string"""
+        try:
+            return self._plans[selector]
+        except KeyError:
+            return self._plans.setdefault(selector, xpath.XPath(selector))
+
+
+
+
+class LxmlPlan(object):
+    """
+    compiled lxml selector that mimics the xpath.XPath api
+
+    """
+    def __init__(self, selector):
+        self.selector = selector
+        self.xpath = etree.XPath(selector)
+        self._string = etree.XPath("string()")
+
+    def find(self, node):
+        return self.xpath(node)
+
+    def findnode(self, node):
+        result = self.xpath(node)
+        if result:
+            return result[0]
+        return None
+
+    def findvalue(self, node):
+        result = self.xpath(node)
+        if not isinstance(result, list):
+            return result
+        if not result:
+            return None
+        first = result[0]
+        if isinstance(first, basestring):
+            # attribute and text results are smart strings
+            return unicode(first)
+        # string-value of an element is all of its descendant text
+        return unicode(self._string(first))
+
+
+
+
+class LxmlEngine(object):
+    """
+    parse and select with lxml/libxml2
+
+    Namespaces are stripped from element tags while parsing, so that
+    unprefixed selectors match the same elements they match under minidom.
+
+    """
+    name = "lxml"
+    node_types = (etree._Element, etree._ElementTree) if etree else ()
+
+    # entities are left unresolved and nothing is fetched over the network,
+    # so responses can't make us read local files or other urls
+    parser_options = dict(resolve_entities=False, no_network=True)
+
+    def __init__(self):
+        self._plans = {}
+        # lxml parsers must not be used by two threads at once
+        self._local = threading.local()
+
+    @property
+    def parser(self):
+        """the XMLParser for the current thread"""
+        try:
+            return self._local.parser
+        except AttributeError:
+            self._local.parser = etree.XMLParser(**self.parser_options)
+            return self._local.parser
+
+    def parse_string(self, text):
+        if isinstance(text, unicode):
+            # lxml refuses unicode strings with an encoding declaration
+            text = text.encode("utf-8")
+        root = etree.fromstring(text, self.parser)
+        strip_namespaces(root)
+        return root.getroottree()
+
+    def iterparse(self, stream, steps):
+        """
+        yield each element of stream whose path matches steps as soon as it
+        closes.  Yielded subtrees, and the siblings before them, are freed
+        once the consumer moves on.
+
+        """
+        path = []
+        events = etree.iterparse(stream, events=("start", "end"),
+                                 **self.parser_options)
+        for event, el in events:
+            if event == "start":
+                path.append(local_name(el.tag))
+                continue
+            if match_path(path, steps):
+                strip_namespaces(el)
+                yield el
+                el.clear()
+                while el.getprevious() is not None:
+                    del el.getparent()[0]
+            path.pop()
+
+    def compile(self, selector):
+        """return compiled plan for selector, cached per selector string"""
+        try:
+            return self._plans[selector]
+        except KeyError:
+            return self._plans.setdefault(selector, LxmlPlan(selector))
+
+
+def local_name(tag):
+    """strip the namespace uri from an lxml tag"""
+    if tag[0] == "{":
+        return tag.split("}", 1)[1]
+    return tag
+
+
+def strip_namespaces(root):
+    """remove namespace uris from the tags of root and its descendants"""
+    for el in root.iter(etree.Element):
+        el.tag = local_name(el.tag)
+    etree.cleanup_namespaces(root)
+
+
+
+
+_step_re = re.compile(r"^(\*|[\w.\-]+)$")
+
+
+def path_steps(selector):
+    """
+    Split a simple absolute location path (e.g. "/*/Items/Item") into a
+    list of name tests that streaming engines can match element paths
+    against.  Raise ValueError for anything more complex.
+
+    """
+    steps = selector.split("/")[1:]
+    if (not selector.startswith("/") or
+            [step for step in steps if not _step_re.match(step)]):
+        raise ValueError("Selector %s is not a simple absolute path and "
+                         "cannot be streamed" % selector)
+    return steps
+
+
+def match_path(path, steps):
+    """True if the element names in path match the name tests in steps"""
+    if len(path) != len(steps):
+        return False
+    for name, step in zip(path, steps):
+        if step != "*" and step != name:
+            return False
+    return True
+
+
+
+
+# registered engines, by name
+ENGINES = {}
+# engine lookup cache, by node type
+_engines_by_type = {}
+
+
+def register_engine(engine):
+    """make an engine instance available to get_engine() and engine_for()"""
+    ENGINES[engine.name] = engine
+    _engines_by_type.clear()
+    return engine
+
+
+def get_engine(engine=None):
+    """
+    Return a registered engine
+
+    engine may be an engine instance, an engine name, or None for the
+    configured default (settings.XML_ENGINE, else lxml if available, else
+    minidom).
+
+    """
+    if engine is None:
+        engine = XML_ENGINE or ("lxml" if "lxml" in ENGINES else "minidom")
+    if isinstance(engine, basestring):
+        try:
+            return ENGINES[engine]
+        except KeyError:
+            raise ValueError("Unknown XML engine: %s" % engine)
+    return engine
+
+
+def engine_for(node):
+    """Return the engine that produced node"""
+    node_type = type(node)
+    try:
+        return _engines_by_type[node_type]
+    except KeyError:
+        pass
+    for engine in ENGINES.values():
+        if isinstance(node, engine.node_types):
+            return _engines_by_type.setdefault(node_type, engine)
+    # fall back on minidom, which also copes with non-dom nodes
+    return ENGINES["minidom"]
+
+
+register_engine(MinidomEngine())
+if etree is not None:
+    register_engine(LxmlEngine())
@@ -0,0 +1,86 @@
+"""
+Single-flight coalescing of concurrent identical requests
+
+When several threads ask for the same keys at once, only the first sends a
+request for them; the others wait for that request and receive its result,
+or its error.
+
+"""
+# stdlib imports
+import threading
+
+
+
+
+class Flight(object):
+    """a request in progress for one key"""
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+    def wait(self):
+        self.done.wait()
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+
+
+class SingleFlight(object):
+    """
+    Coalesces concurrent requests for overlapping sets of keys
+
+    """
+    def __init__(self):
+        self.flights = {}
+        self.lock = threading.Lock()
+
+
+    def do_many(self, keys, fn, share=None):
+        """
+        Return a dict of results for keys, requesting each key only once
+        across concurrent callers.
+
+        fn is called with the list of keys not already in flight, and must
+        return a dict of results for them (keys without a result may be
+        left out).  Keys already in flight are waited for instead; if their
+        request fails, its error is raised here too.  share, if given, is
+        applied to each result received from another caller's request, e.g.
+        to give this caller its own copy.
+
+        """
+        mine, theirs = {}, {}
+        with self.lock:
+            for key in keys:
+                if key in mine or key in theirs:
+                    continue
+                if key in self.flights:
+                    theirs[key] = self.flights[key]
+                else:
+                    mine[key] = self.flights[key] = Flight()
+
+        results = {}
+        if mine:
+            try:
+                results.update(fn(list(mine)))
+            except Exception as e:
+                for flight in mine.values():
+                    flight.error = e
+                raise
+            else:
+                for key, flight in mine.items():
+                    flight.result = results.get(key)
+            finally:
+                with self.lock:
+                    for key in mine:
+                        del self.flights[key]
+                for flight in mine.values():
+                    flight.done.set()
+
+        for key, flight in theirs.items():
+            result = flight.wait()
+            if result is not None:
+                results[key] = share(result) if share else result
+        return results
@@ -0,0 +1,123 @@
+"""
+Rebuild books from archived amazon api responses
+
+    ./manage.py import_books /var/archive/amazon --processes 8
+
+Responses (.xml, or gzipped .xml.gz) are parsed on a pool of processes
+with AmazonBookInterface's mappings; workers only return attribute dicts,
+and this process writes them to the database in batched upserts.  Files
+are applied in sorted path order, so later responses win.
+
+"""
+# stdlib imports
+import gzip
+import os
+import sys
+from multiprocessing import Pool, cpu_count
+from optparse import make_option
+# django imports
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+# local imports
+from bserial.serial import AmazonBookInterface
+
+
+# interface of each worker process, see _init_worker
+_interface = [None]
+
+
+def _init_worker(engine):
+    _interface[0] = AmazonBookInterface(engine=engine)
+
+
+def _read(path):
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, "rb") as f:
+        return f.read()
+
+
+def parse_file(path, interface=None):
+    """
+    Parse the items of an archived response into attribute dicts, without
+    touching the database.  Returns (path, rows, error message or None).
+
+    """
+    interface = interface or _interface[0]
+    try:
+        doc, item_errors = interface.check_response(_read(path))
+        rows = [interface.parse_attrs(item)
+                for item in interface.item_root.parse(doc)]
+    except Exception as e:
+        return path, [], "%s: %s" % (type(e).__name__, e)
+    return path, rows, None
+
+
+def find_files(paths):
+    """list archived responses in paths (files or directories), sorted"""
+    out = []
+    for path in paths:
+        if not os.path.isdir(path):
+            out.append(path)
+            continue
+        for root, dirs, files in os.walk(path):
+            out += [os.path.join(root, name) for name in files
+                    if name.endswith(".xml") or name.endswith(".xml.gz")]
+    return sorted(out)
+
+
+
+
+class Command(BaseCommand):
+    args = "<file or directory> ..."
+    help = "Import books from archived amazon api responses"
+    option_list = BaseCommand.option_list + (
+        make_option("--processes", type="int", default=None,
+                    help="parser processes (default: one per cpu)"),
+        make_option("--batch-size", type="int", default=500,
+                    dest="batch_size",
+                    help="books written per upsert (default: 500)"),
+        make_option("--engine", default=None,
+                    help="xml engine: lxml or minidom (default: best "
+                         "available)"),
+    )
+
+    def handle(self, *args, **options):
+        if not args:
+            raise CommandError("Give at least one file or directory")
+        files = find_files(args)
+        processes = options.get("processes") or cpu_count()
+        batch_size = options.get("batch_size") or 500
+        engine = options.get("engine")
+        interface = AmazonBookInterface(engine=engine)
+        stdout = getattr(self, "stdout", sys.stdout)
+        stderr = getattr(self, "stderr", sys.stderr)
+
+        if processes > 1:
+            # forked workers must not share this process's db connections
+            for connection in connections.all():
+                connection.close()
+            pool = Pool(processes, _init_worker, (engine,))
+            parsed = pool.imap(parse_file, files,
+                               max(1, len(files) // (processes * 4)))
+        else:
+            pool = None
+            parsed = (parse_file(path, interface) for path in files)
+
+        batch, books, failed = [], 0, 0
+        try:
+            for path, rows, error in parsed:
+                if error is not None:
+                    failed += 1
+                    stderr.write("skipped %s (%s)\n" % (path, error))
+                    continue
+                batch += rows
+                if len(batch) >= batch_size:
+                    books += len(interface.upsert(batch))
+                    batch = []
+            if batch:
+                books += len(interface.upsert(batch))
+        finally:
+            if pool is not None:
+                pool.terminate()
+        stdout.write("imported %d books from %d files (%d skipped)\n" % (
+                books, len(files) - failed, failed))
@@ -0,0 +1,120 @@
+"""
+Refresh the amazon data of stale books
+
+    ./manage.py refresh_books --max-age 24 --budget 500 --window 30
+
+Books not refreshed within max-age hours are looked up, most read first
+and then least recently refreshed first, until the request budget or the
+time window runs out.  Each book's last_refreshed is set as it is done, so
+an interrupted or budget limited run is resumed by the next one.
+
+"""
+# stdlib imports
+import sys
+import time
+from datetime import timedelta
+from optparse import make_option
+# django imports
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.db.models import Q
+from django.utils import timezone
+# local imports
+from bserial.models import Book
+from bserial.query import BatchResult
+from bserial.settings import AMAZON_CONCURRENCY
+
+
+# books marked as refreshed per update query
+MARK_CHUNK_SIZE = 100
+
+
+def stale_books(max_age, now=None):
+    """
+    books not refreshed within max_age, in refresh priority order: most
+    read first, then never refreshed, then least recently refreshed
+
+    """
+    now = now or timezone.now()
+    stale = Book.objects.filter(Q(last_refreshed__isnull=True) |
+                                Q(last_refreshed__lt=now - max_age))
+    # backends disagree on where NULLs sort, so order on them explicitly
+    column = "%s.%s" % (connection.ops.quote_name(Book._meta.db_table),
+                        connection.ops.quote_name("last_refreshed"))
+    stale = stale.extra(select={
+            "refreshed": "CASE WHEN %s IS NULL THEN 0 ELSE 1 END" % column})
+    return stale.order_by("-access_count", "refreshed", "last_refreshed",
+                          "pk")
+
+
+def refresh(max_age, budget=None, window=None, concurrency=AMAZON_CONCURRENCY,
+            clock=time.time):
+    """
+    Look up stale books within a budget of amazon requests and a window of
+    seconds, marking each one done as its chunk is saved.
+
+    Each chunk of ItemIds gets a single request, without retries, so the
+    budget is the number of requests sent.  No chunk is started after the
+    window closes.  ItemIds amazon rejects are marked done too, so they
+    don't hold up the queue until max_age passes again; chunks that failed
+    stay stale for the next run.  Returns the BatchResult.
+
+    """
+    deadline = None if window is None else clock() + window
+    asins = stale_books(max_age).values_list("asin", "refreshed")
+    if budget is not None:
+        asins = asins[:budget * Book.amazon.get_query_set()._max_results]
+    result = BatchResult()
+    marked = [0, 0]
+
+    def item_ids():
+        # checked as iter_lookup pulls each chunk, even if none succeed
+        for asin, refreshed in list(asins):
+            if deadline is not None and clock() >= deadline:
+                return
+            yield asin
+
+    def mark(force=False):
+        done = (result.succeeded[marked[0]:] + result.skipped[marked[1]:])
+        if done and (force or len(done) >= MARK_CHUNK_SIZE):
+            Book.objects.filter(asin__in=done).update(
+                    last_refreshed=timezone.now())
+            marked[:] = [len(result.succeeded), len(result.skipped)]
+
+    books = Book.amazon.iter_lookup(item_ids(), concurrency=concurrency,
+                                    retries=0, result=result)
+    try:
+        for book in books:
+            mark()
+    finally:
+        books.close()
+        mark(force=True)
+    return result
+
+
+
+
+class Command(BaseCommand):
+    help = "Refresh the amazon data of stale books"
+    option_list = BaseCommand.option_list + (
+        make_option("--max-age", type="float", default=24, dest="max_age",
+                    help="hours after which books are stale (default: 24)"),
+        make_option("--budget", type="int", default=None,
+                    help="most amazon requests to send (default: no limit)"),
+        make_option("--window", type="float", default=None,
+                    help="minutes to run for at most (default: no limit)"),
+        make_option("--concurrency", type="int", default=AMAZON_CONCURRENCY,
+                    help="requests sent at the same time"),
+    )
+
+    def handle(self, *args, **options):
+        max_age = timedelta(hours=options.get("max_age") or 24)
+        window = options.get("window")
+        result = refresh(max_age, options.get("budget"),
+                         window * 60 if window is not None else None,
+                         options.get("concurrency") or AMAZON_CONCURRENCY)
+        stdout = getattr(self, "stdout", sys.stdout)
+        stdout.write("refreshed %d books, %d skipped, %d failed, %d still "
+                     "stale\n" % (len(result.succeeded), len(result.skipped),
+                                   len(result.failed),
+                                   stale_books(max_age).count()))
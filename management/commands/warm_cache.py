@@ -0,0 +1,28 @@
+"""
+Preload the most read books into the model cache
+
+    ./manage.py warm_cache --count 5000
+
+Run at deploy or startup so that new processes don't start cold.
+
+"""
+# stdlib imports
+import sys
+from optparse import make_option
+# django imports
+from django.core.management.base import BaseCommand
+# local imports
+from bserial.access import warm_cache
+
+
+class Command(BaseCommand):
+    help = "Preload the most read books into the model cache"
+    option_list = BaseCommand.option_list + (
+        make_option("--count", type="int", default=1000,
+                    help="books to load (default: 1000)"),
+    )
+
+    def handle(self, *args, **options):
+        loaded = warm_cache(options.get("count") or 1000)
+        stdout = getattr(self, "stdout", sys.stdout)
+        stdout.write("loaded %d books into the cache\n" % loaded)
@@ -15,5 +15,17 @@ class AmazonManager(CacheManager):
         return AmazonQuerySet(self.model)
     def lookup(self, *args, **kwargs):
         return self.get_query_set().lookup(*args, **kwargs)
+    def batch_lookup(self, *args, **kwargs):
+        return self.get_query_set().batch_lookup(*args, **kwargs)
+    def iter_lookup(self, *args, **kwargs):
+        return self.get_query_set().iter_lookup(*args, **kwargs)
     def search(self, *args, **kwargs):
         return self.get_query_set().search(*args, **kwargs)
+    def iter_search(self, *args, **kwargs):
+        return self.get_query_set().iter_search(*args, **kwargs)
+    def alookup(self, *args, **kwargs):
+        return self.get_query_set().alookup(*args, **kwargs)
+    def abatch_lookup(self, *args, **kwargs):
+        return self.get_query_set().abatch_lookup(*args, **kwargs)
+    def asearch(self, *args, **kwargs):
+        return self.get_query_set().asearch(*args, **kwargs)
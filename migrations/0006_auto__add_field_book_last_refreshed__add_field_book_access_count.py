@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+import datetime
+from south.db import db
+from south.v2 import SchemaMigration
+from django.db import models
+
+
+class Migration(SchemaMigration):
+
+    def forwards(self, orm):
+        # Adding field 'Book.last_refreshed'
+        db.add_column('bserial_book', 'last_refreshed',
+                      self.gf('django.db.models.fields.DateTimeField')(db_index=True, null=True, blank=True),
+                      keep_default=False)
+
+        # Adding field 'Book.access_count'
+        db.add_column('bserial_book', 'access_count',
+                      self.gf('django.db.models.fields.PositiveIntegerField')(default=0, db_index=True),
+                      keep_default=False)
+
+
+    def backwards(self, orm):
+        # Deleting field 'Book.last_refreshed'
+        db.delete_column('bserial_book', 'last_refreshed')
+
+        # Deleting field 'Book.access_count'
+        db.delete_column('bserial_book', 'access_count')
+
+
+    models = {
+        'bserial.book': {
+            'Meta': {'object_name': 'Book'},
+            'access_count': ('django.db.models.fields.PositiveIntegerField', [], {'default': '0', 'db_index': 'True'}),
+            'asin': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '10', 'db_index': 'True'}),
+            'author': ('django.db.models.fields.CharField', [], {'max_length': '128', 'blank': 'True'}),
+            'cover_lg_url': ('django.db.models.fields.TextField', [], {'null': 'True', 'blank': 'True'}),
+            'cover_md_url': ('django.db.models.fields.TextField', [], {'null': 'True', 'blank': 'True'}),
+            'cover_sm_url': ('django.db.models.fields.TextField', [], {'null': 'True', 'blank': 'True'}),
+            'description': ('django.db.models.fields.TextField', [], {'null': 'True', 'blank': 'True'}),
+            'detail_page_url': ('django.db.models.fields.TextField', [], {'null': 'True', 'blank': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'last_refreshed': ('django.db.models.fields.DateTimeField', [], {'db_index': 'True', 'null': 'True', 'blank': 'True'}),
+            'title': ('django.db.models.fields.CharField', [], {'max_length': '128', 'blank': 'True'})
+        }
+    }
+
+    complete_apps = ['bserial']
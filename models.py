@@ -2,10 +2,10 @@
 from django.db import models
 # 3rd party imports
 from bserial.manager import CacheManager, AmazonManager
-from bserial.util import merge_objects
+from bserial.util import merge_into, DirtyFieldsMixin
 
 # Create your models here.
-class Book(models.Model):
+class Book(DirtyFieldsMixin, models.Model):
     """
     A Book to be referenced in our publications
 
@@ -21,6 +21,13 @@ class Book(models.Model):
     description = models.TextField(null=True, blank=True)
     detail_page_url = models.TextField(null=True, blank=True)
 
+    # when amazon data was last refreshed (see the refresh_books command),
+    # and how often the book is read
+    last_refreshed = models.DateTimeField(null=True, blank=True,
+                                          db_index=True, editable=False)
+    access_count = models.PositiveIntegerField(default=0, db_index=True,
+                                               editable=False)
+
     objects = CacheManager()
     amazon = AmazonManager()
 
@@ -33,7 +40,7 @@ class Book(models.Model):
     def lookup(self, *args, **kwargs):
         args = (self.asin,) + args
         bl = self.__class__.amazon.lookup(*args, **kwargs)[0]
-        merge_objects(self, bl)
+        merge_into(self, bl)
 
     def __unicode__(self):
         return "%s%s" % (
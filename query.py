@@ -1,11 +1,20 @@
 # stdlib imports
-from copy import deepcopy
+import time
+from multiprocessing import TimeoutError
 # django imports
 from django.db.models.query import QuerySet
 # 3rd party imports
 # local imports
-from bserial.settings import DEFAULT_CACHE
-from bserial.util import merge_objects, get_cache_key
+from bserial.settings import (AMAZON_CONCURRENCY, AMAZON_RETRIES,
+                              AMAZON_RETRY_BACKOFF)
+from bserial.access import get_tracker
+from bserial.flight import SingleFlight
+from bserial.responses import get_negative_cache
+from bserial.tiered import TieredCache, get_model_cache
+from bserial.util import (chunked, merge_objects, copy_object, get_cache_key,
+                          get_cache_keys, pack_object, unpack_object,
+                          DirtyFieldsMixin)
+from bserial.workers import bounded_imap, get_pool, retry
 
 
 
@@ -19,68 +28,256 @@ class CacheQuerySet(QuerySet):
     retrieve them.
 
     """
+    # number of results merged per cache round trip while iterating
+    _cache_chunk_size = 100
+    # count reads of models with an access_count field (see bserial.access)
+    _track_access = True
+
     def __init__(self, model=None, query=None, using=None, 
-                 cache=DEFAULT_CACHE, timeout=30):
+                 cache=None, timeout=30):
         super(CacheQuerySet, self).__init__(model, query, using)
-        self.cache = cache
+        # default to DEFAULT_CACHE, behind a local tier if one is configured
+        self.cache = get_model_cache() if cache is None else cache
         self.timeout = timeout
 
 
+    def _clone(self, *args, **kwargs):
+        c = super(CacheQuerySet, self)._clone(*args, **kwargs)
+        c.cache = self.cache
+        c.timeout = self.timeout
+        c._track_access = self._track_access
+        return c
+
+
+    def untracked(self):
+        """copy of this queryset whose reads aren't counted as accesses"""
+        c = self._clone()
+        c._track_access = False
+        return c
+
+
     def _cache_key(self, obj):
         return get_cache_key(obj)
 
 
+    def _cache_keys(self, objs):
+        return get_cache_keys(objs)
+
+
+    def _save(self, obj, loaded):
+        """
+        save obj, writing only the fields that changed since loaded (the
+        object it was merged from) was loaded, if the model tracks them
+
+        """
+        if isinstance(obj, DirtyFieldsMixin):
+            obj.save_dirty(loaded)
+        else:
+            obj.save()
+
+
+    def _pack(self, obj):
+        return pack_object(obj)
+
+
+    def _unpack(self, data):
+        return unpack_object(data, self.model)
+
+
+    def _cache_get_objects(self, keys):
+        """
+        Return a dict of cached objects for keys, unpacking them.  A
+        TieredCache keeps objects unpacked in its local tier, so it is left
+        to unpack only what it reads from its shared tier.
+
+        """
+        if isinstance(self.cache, TieredCache):
+            return self.cache.get_many(keys, unpack=self._unpack)
+        out = {}
+        for key, data in self.cache.get_many(keys).items():
+            obj = self._unpack(data)
+            if obj is not None:
+                out[key] = obj
+        return out
+
+
+    def _cache_set_objects(self, objs, timeout=None):
+        """Cache a dict of objects by key, packing them (see above)"""
+        if isinstance(self.cache, TieredCache):
+            self.cache.set_many(objs, timeout, pack=self._pack)
+        else:
+            self.cache.set_many({key: self._pack(obj)
+                                 for key, obj in objs.items()}, timeout)
+
+
+    def _merge(self, obj, cached_obj, passive=False):
+        """merge a cached object into obj, if there is one"""
+        if not cached_obj:
+            return obj
+        if passive:
+            return merge_objects(cached_obj, obj)
+        return merge_objects(obj, cached_obj)
+
+
     def cache_add(self, obj, timeout=None, passive=False):
         """store an object in the cache for later retrieval"""
-        # make sure object is the correct type
-        if not isinstance(obj, self.model):
-            raise TypeError("%s is not a model in this QuerySet." % obj)
-        # get storage key
-        key = self._cache_key(obj)
-        # retrieve already cached object, if any
-        cached_obj = self.cache.get(key, None)
-        if cached_obj:
+        self.cache_add_many([obj], timeout, passive)
+
+
+    def cache_add_many(self, objs, timeout=None, passive=False):
+        """
+        store objects in the cache for later retrieval
+
+        Already cached objects are fetched with a single get_many, and the
+        merged objects stored with a single set_many.
+
+        """
+        # make sure objects are the correct type
+        for obj in objs:
+            if not isinstance(obj, self.model):
+                raise TypeError("%s is not a model in this QuerySet." % obj)
+        # get storage keys
+        keys = self._cache_keys(objs)
+        # retrieve already cached objects, if any
+        cached = self._cache_get_objects(keys)
+        out = {}
+        for key, obj in zip(keys, objs):
             # merge cached object into object
-            if  passive:
-                obj = merge_objects(cached_obj, obj)
-            else:
-                obj = merge_objects(obj, cached_obj)
-        # make sure that db and cache match
-        obj.save()
-        # cache pickled object
-        self.cache.set(key, obj, timeout)
+            merged = self._merge(obj, cached.get(key), passive)
+            # make sure that db and cache match
+            self._save(merged, obj)
+            out[key] = merged
+        # cache merged objects
+        self._cache_set_objects(out, timeout)
 
 
     def _cache_get(self, obj, passive=False):
         """retrieve object from cache, if any, and merge data"""
-        key = self._cache_key(obj)
-        cached_obj = self.cache.get(key, None)
-        if cached_obj:
-            if passive:
-                return merge_objects(cached_obj, obj)
+        return self._cache_get_many([obj], passive)[0]
+
+
+    def _cache_get_many(self, objs, passive=False):
+        """retrieve objects from cache with one round trip, and merge data"""
+        keys = self._cache_keys(objs)
+        cached = self._cache_get_objects(keys)
+        return [self._merge(obj, cached.get(key), passive)
+                for key, obj in zip(keys, objs)]
+
+
+    def iterator(self):
+        """
+        Iterate over results, merging them with any cached results
+
+        Results are merged in chunks, with one cache round trip per chunk.
+        Iteration, len(), slicing, indexing and get() all go through here,
+        and count as accesses unless the queryset is untracked().
+
+        """
+        tracker = get_tracker(self.model) if self._track_access else None
+        chunk = []
+        for obj in super(CacheQuerySet, self).iterator():
+            chunk.append(obj)
+            if len(chunk) >= self._cache_chunk_size:
+                if tracker is not None:
+                    tracker.record([obj.pk for obj in chunk])
+                for merged in self._cache_get_many(chunk):
+                    yield merged
+                chunk = []
+        if chunk:
+            if tracker is not None:
+                tracker.record([obj.pk for obj in chunk])
+            for merged in self._cache_get_many(chunk):
+                yield merged
+
+
+
+
+class BatchResult(list):
+    """
+    Books returned by a batch lookup, in input order, along with the fate of
+    every requested ItemId (recorded, without the books, by iter_lookup):
+
+    succeeded   ItemIds looked up
+    failed      dict of ItemIds whose chunk failed, and the error
+    skipped     ItemIds amazon reported (now or recently) as invalid
+
+    """
+    def __init__(self, *args):
+        super(BatchResult, self).__init__(*args)
+        self.succeeded = []
+        self.failed = {}
+        self.skipped = []
+
+    def add_chunk(self, item_ids, books, is_asin=True):
+        """record the ItemIds of a chunk of item_ids and its books"""
+        if not is_asin:
+            # books can't be matched to the ids requested
+            self.succeeded += item_ids
+            return
+        found = set(book.asin for book in books)
+        for item_id in item_ids:
+            if item_id in found:
+                self.succeeded.append(item_id)
             else:
-                return merge_objects(obj, cached_obj)
-        return obj
+                self.skipped.append(item_id)
+
+
+
+
+class PendingLookup(object):
+    """
+    Result of an asynchronous amazon request
 
-    def get(self, *args, **kwargs):
-        out = super(CacheQuerySet, self).get(*args, **kwargs)
-        return self._cache_get(out)
+    Requests, parsing their xml and mapping its items to attributes run on
+    the shared worker pool.  Books are saved and cached by the first call to
+    get(), in the calling thread, since django database connections belong
+    to the thread that opened them.
 
+    Arguments:
+    ----------
+    0   pending     list of AsyncResults of the requests
+    1   finish      called with the list of their results, returns the books
 
-    def __getitem__(self, k):
+    """
+    def __init__(self, pending, finish):
+        self.pending = pending
+        self.finish = finish
+        self.finished = False
+        self.result = None
+
+    def ready(self):
+        """True if every request is done, so get() won't wait for amazon"""
+        return all(r.ready() for r in self.pending)
+
+    def wait(self, timeout=None):
+        """Wait up to timeout seconds for every request to be done"""
+        deadline = None if timeout is None else time.time() + timeout
+        for r in self.pending:
+            if deadline is None:
+                r.wait()
+            else:
+                r.wait(max(deadline - time.time(), 0))
+
+    def get(self, timeout=None):
         """
-        Retrieves an item or slice from the set of results, and merges it with
-        any cached results
+        Return the books, waiting up to timeout seconds for the requests.
+        Raise multiprocessing.TimeoutError if they aren't done by then, or
+        the error a request failed with.
 
         """
-        out = super(CacheQuerySet, self).__getitem__(k)
-        if isinstance(out, list):
-            return [self._cache_get(obj) for obj in out]
-        elif isinstance(out, self.model):
-            return self._cache_get(out)
-        return out
-    
+        if not self.finished:
+            self.wait(timeout)
+            if not self.ready():
+                raise TimeoutError()
+            self.result = self.finish([r.get() for r in self.pending])
+            self.finished = True
+        return self.result
+
+
+
 
+# in-flight amazon lookups, shared by every AmazonQuerySet
+_lookups = SingleFlight()
 
 
 class AmazonQuerySet(CacheQuerySet):
@@ -89,28 +286,63 @@ class AmazonQuerySet(CacheQuerySet):
 
     """
     _max_results = 10
+    _amazon = None
 
-    def __init__(self, model=None, query=None, using=None, 
-                 cache=DEFAULT_CACHE, timeout=30):
-        super(AmazonQuerySet, self).__init__(model, query, using, cache, 
-                                            timeout)
-        # deferred import because bserial.serial uses Book model
-        from bserial.serial import AmazonBookInterface
-        self.amazon = AmazonBookInterface()
+    @property
+    def amazon(self):
+        """AmazonBookInterface shared by every AmazonQuerySet"""
+        if AmazonQuerySet._amazon is None:
+            # deferred import because bserial.serial uses Book model
+            from bserial.serial import AmazonBookInterface
+            AmazonQuerySet._amazon = AmazonBookInterface()
+        return AmazonQuerySet._amazon
 
         
     def lookup(self, *args, **kwargs):
+        """
+        Look up books on amazon, then save and cache them
+
+        ItemIds are taken from the first argument or the ItemId keyword, or
+        from the books in this queryset; ItemIds amazon recently reported as
+        invalid are skipped.  Concurrent lookups in this process share
+        requests: each ItemId already being looked up by another thread is
+        waited for rather than requested again.
+
+        """
         # if no id's specified, use books in this queryset
-        if not args and not kwargs.has_key("ItemId"):
-            kwargs["ItemId"] = [
-                    book.asin for book in self.all()[:self._max_results]
-            ]
-        # perform lookup.  books is a list.  no results => empty
-        books = self.amazon.lookup(*args, **kwargs)
-        # cache results
-        for book in books:
-            self.cache_add(book)
-        return books
+        item_ids, args, kwargs = self._item_ids(
+                args, kwargs,
+                self.values_list("asin", flat=True)[:self._max_results])
+        item_ids, invalid_ids = self._skip_invalid(item_ids, kwargs)
+        if not item_ids:
+            return []
+
+        def lookup(item_ids):
+            # perform lookup.  books is a list.  no results => empty
+            books = self.amazon.lookup(",".join(item_ids), *args, **kwargs)
+            # cache results
+            self.cache_add_many(books)
+            return books
+
+        # results can only be matched to requests by asin
+        if kwargs.get("IdType", "ASIN") != "ASIN":
+            return lookup(item_ids)
+        # lookups only share results if their other arguments match
+        request = repr((args, sorted(kwargs.items())))
+
+        # books whose asin wasn't requested as such go to this caller only
+        unmatched = []
+
+        def fetch(keys):
+            books = lookup([asin for r, asin in keys])
+            fetched = {(request, book.asin): book for book in books}
+            unmatched.extend(book for key, book in fetched.items()
+                             if key not in keys)
+            return fetched
+
+        keys = [(request, asin) for asin in item_ids]
+        books = _lookups.do_many(keys, fetch, share=copy_object)
+        return [books[key] for key in keys if key in books] + unmatched
 
     def batch_lookup(self, *args, **kwargs):
         """
@@ -119,31 +351,286 @@ class AmazonQuerySet(CacheQuerySet):
         
         It will keep sending amazon api requests, regardless of how many books
         are out there.
+
+        Takes the same keywords as iter_lookup, and returns a BatchResult:
+        the list of books, also reporting succeeded, failed and skipped
+        ItemIds.  Use iter_lookup to refresh more books than fit in memory.
         """
-        # if no id's specified, use books in this queryset
-        if not args and not kwargs.has_key("ItemId"):
-            kwargs["ItemId"] = [
-                    book.asin for book in self.all()
-            ]
-        books = []
-        # iterate through item ids in steps, performing a lookup for each
-        for seg_index in xrange(0,len(kwargs["ItemId"]), self._max_results):
-            seg_ciel = seg_index + self._max_results
-            seg_ids = kwargs["ItemId"][seg_index:seg_ciel]
-            seg_kwargs = deepcopy(kwargs)
-            seg_kwargs["ItemId"] = seg_ids
-            seg_books = self.amazon.lookup(*args, **seg_kwargs)
-            books += seg_books
-        # cache results
-        for book in books:
-            self.cache_add(book)
+        result = BatchResult()
+        result.extend(self.iter_lookup(*args, result=result, **kwargs))
+        return result
+
+
+    def iter_lookup(self, *args, **kwargs):
+        """
+        DANGEROUS!
+        same as batch_lookup, but yields books as each chunk is looked up,
+        saved and cached, so memory use doesn't grow with the number of books
+
+        ItemIds are streamed from the database when none are given, and
+        iterators of ItemIds are consumed lazily, a chunk at a time.
+
+        Keywords:
+        ---------
+        concurrency(int)=AMAZON_CONCURRENCY  requests sent at the same time
+        retries(int)=AMAZON_RETRIES          retries per chunk
+        backoff(float)=AMAZON_RETRY_BACKOFF  base of retry backoff (seconds)
+        result(BatchResult)=None             records succeeded, failed and
+                                             skipped ItemIds
+
+        Requests, and parsing their responses, run on a pool of concurrency
+        threads, and chunks that fail with transient errors are retried with
+        jittered exponential backoff.  Books are saved and cached chunk by
+        chunk, in input order, in this thread, so a chunk that fails for good
+        does not lose the others.  ItemIds amazon recently reported as invalid are skipped.
+        """
+        concurrency = kwargs.pop("concurrency", AMAZON_CONCURRENCY)
+        retries = kwargs.pop("retries", AMAZON_RETRIES)
+        backoff = kwargs.pop("backoff", AMAZON_RETRY_BACKOFF)
+        # outcomes are only kept if asked for, so memory use stays flat
+        result = kwargs.pop("result", None)
+        item_ids, args, kwargs = self._item_ids(
+                args, kwargs,
+                self.values_list("asin", flat=True).iterator(), lazy=True)
+        is_asin = kwargs.get("IdType", "ASIN") == "ASIN"
+
+        def chunks():
+            for chunk in chunked(item_ids, self._max_results):
+                chunk, invalid_ids = self._skip_invalid(chunk, kwargs)
+                if result is not None:
+                    result.skipped += invalid_ids
+                if chunk:
+                    yield chunk
+
+        def fetch(chunk):
+            return self._fetch_chunk(chunk, args, kwargs, retries, backoff)
+
+        for chunk, checked in bounded_imap(fetch, chunks(), concurrency):
+            for book in self._finish_chunk(result, chunk, checked, is_asin):
+                yield book
+
+
+    def _fetch_chunk(self, chunk, args, kwargs, retries, backoff):
+        """
+        request, validate and map a chunk of ItemIds, without touching the
+        database, retrying transient errors.  Returns (chunk, the result of
+        check_rows or the final error).
+
+        """
+        # deferred import because bserial.serial uses Book model
+        from bserial.serial import is_transient
+        def request():
+            return self.amazon.check_rows(
+                    self.amazon._item_lookup_response(",".join(chunk),
+                                                      *args, **kwargs))
+        try:
+            return chunk, retry(request, is_transient, retries, backoff)
+        except Exception as e:
+            return chunk, e
+
+
+    def _finish_chunk(self, result, chunk, checked, is_asin):
+        """
+        save and cache the books of a fetched chunk, recording the
+        outcome in result unless it is None.  Returns the books, or [] if
+        the chunk failed.
+
+        """
+        try:
+            if isinstance(checked, Exception):
+                raise checked
+            books = self.amazon.upsert_checked(checked,
+                                               chunk if is_asin else None)
+            # cache results
+            self.cache_add_many(books)
+        except Exception as e:
+            if result is not None:
+                result.failed.update((item_id, e) for item_id in chunk)
+            return []
+        if result is not None:
+            result.add_chunk(chunk, books, is_asin)
         return books
 
-            
-    
+
+    def alookup(self, *args, **kwargs):
+        """
+        Asynchronous lookup: returns a PendingLookup at once, whose get()
+        returns the books lookup would have.
+
+        The request runs on the shared pool of AMAZON_CONCURRENCY threads.
+        Unlike lookup, it isn't shared with concurrent lookups of the same
+        ItemIds.
+
+        """
+        item_ids, args, kwargs = self._item_ids(
+                args, kwargs,
+                self.values_list("asin", flat=True)[:self._max_results])
+        item_ids, invalid_ids = self._skip_invalid(item_ids, kwargs)
+        if not item_ids:
+            return PendingLookup([], lambda checked: [])
+        is_asin = kwargs.get("IdType", "ASIN") == "ASIN"
+
+        def fetch():
+            return self.amazon.check_rows(
+                    self.amazon._item_lookup_response(",".join(item_ids),
+                                                      *args, **kwargs))
+
+        def finish(checked):
+            books = self.amazon.upsert_checked(checked[0],
+                                               item_ids if is_asin else None)
+            self.cache_add_many(books)
+            return books
+
+        return PendingLookup([get_pool().apply_async(fetch)], finish)
+
+
+    def abatch_lookup(self, *args, **kwargs):
+        """
+        Asynchronous batch_lookup: returns a PendingLookup at once, whose
+        get() returns a BatchResult.
+
+        Every chunk is queued on the shared pool of AMAZON_CONCURRENCY
+        threads, so ItemIds are read up front rather than streamed.  Takes
+        the retries and backoff keywords of batch_lookup.
+
+        """
+        retries = kwargs.pop("retries", AMAZON_RETRIES)
+        backoff = kwargs.pop("backoff", AMAZON_RETRY_BACKOFF)
+        item_ids, args, kwargs = self._item_ids(
+                args, kwargs, self.values_list("asin", flat=True))
+        is_asin = kwargs.get("IdType", "ASIN") == "ASIN"
+        skipped, pending = [], []
+        for chunk in chunked(item_ids, self._max_results):
+            chunk, invalid_ids = self._skip_invalid(chunk, kwargs)
+            skipped += invalid_ids
+            if chunk:
+                pending.append(get_pool().apply_async(
+                        self._fetch_chunk,
+                        (chunk, args, kwargs, retries, backoff)))
+
+        def finish(fetched):
+            result = BatchResult()
+            result.skipped += skipped
+            for chunk, checked in fetched:
+                result.extend(self._finish_chunk(result, chunk, checked,
+                                                 is_asin))
+            return result
+
+        return PendingLookup(pending, finish)
+
+
+    def _skip_invalid(self, item_ids, kwargs):
+        """
+        split item_ids into lists of (ids to look up, ids skipped because
+        amazon recently reported them invalid)
+
+        """
+        negative_cache = get_negative_cache()
+        if negative_cache is None or kwargs.get("IdType", "ASIN") != "ASIN":
+            return item_ids, []
+        return negative_cache.split(item_ids)
+
+
+    def _item_ids(self, args, kwargs, default_ids, lazy=False):
+        """
+        split ItemId(s) out of lookup arguments, as a list of ids
+
+        ItemIds may be the first argument or the ItemId keyword, either as an
+        iterable or a csv string.  If none are given, default_ids are used.
+        Ids are stripped, and ASINs upper cased, so they match the asins of
+        the books amazon returns.  Unless lazy, they are returned as a list.
+        Returns (item_ids, remaining args, remaining kwargs).
+
+        """
+        kwargs = dict(kwargs)
+        if args:
+            item_ids, args = args[0], args[1:]
+        elif "ItemId" in kwargs:
+            item_ids = kwargs.pop("ItemId")
+        else:
+            item_ids = default_ids
+        if isinstance(item_ids, basestring):
+            item_ids = item_ids.split(",")
+        # amazon answers with upper case ASINs, without whitespace
+        item_ids = (item_id.strip() for item_id in item_ids)
+        if kwargs.get("IdType", "ASIN") == "ASIN":
+            item_ids = (item_id.upper() for item_id in item_ids)
+        item_ids = (item_id for item_id in item_ids if item_id)
+        if lazy:
+            return item_ids, args, kwargs
+        return list(item_ids), args, kwargs
+
 
     def search(self, *args, **kwargs):
         books = self.amazon.search(*args, **kwargs)
-        for book in books:
-            self.cache_add(book)
+        self.cache_add_many(books)
         return books
+
+
+    def iter_search(self, *args, **kwargs):
+        """
+        Search amazon, yielding books from every page of results, as each
+        page is saved and cached
+
+        Takes the arguments of search, and the keywords:
+
+        limit(int)=None     stop after this many books
+        prefetch(int)=0     pages requested in the background while the
+                            current one is consumed
+
+        Pages are requested lazily: a limit of 10 or less, or stopping
+        iteration early, only costs the pages needed.
+
+        """
+        limit = kwargs.pop("limit", None)
+        prefetch = kwargs.pop("prefetch", 0)
+        per_page = self._max_results
+        if limit is not None and limit <= 0:
+            return
+
+        def fetch(page):
+            page_kwargs = dict(kwargs, ItemPage=page)
+            return self.amazon.check_response(
+                    self.amazon._item_search_response(*args, **page_kwargs))
+
+        first = fetch(1)
+        total_pages = self.amazon.total_pages(first)
+        if limit is not None:
+            total_pages = min(total_pages, (limit + per_page - 1) // per_page)
+        # page 1 goes through the pool too, so that the pages after it are
+        # already requested by the time its books are yielded
+        pages = bounded_imap(lambda page: first if page == 1 else fetch(page),
+                             xrange(1, total_pages + 1), prefetch + 1)
+        count = 0
+        try:
+            for checked in pages:
+                books = self.amazon.parse_checked(checked)
+                if limit is not None:
+                    books = books[:limit - count]
+                self.cache_add_many(books)
+                for book in books:
+                    yield book
+                count += len(books)
+                if limit is not None and count >= limit:
+                    return
+        finally:
+            # stop any prefetching
+            pages.close()
+
+
+    def asearch(self, *args, **kwargs):
+        """
+        Asynchronous search: returns a PendingLookup at once, whose get()
+        returns the books search would have.
+
+        """
+        def fetch():
+            return self.amazon.check_rows(
+                    self.amazon._item_search_response(*args, **kwargs))
+
+        def finish(checked):
+            books = self.amazon.upsert_checked(checked[0])
+            self.cache_add_many(books)
+            return books
+
+        return PendingLookup([get_pool().apply_async(fetch)], finish)
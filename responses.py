@@ -0,0 +1,215 @@
+"""
+Caches of raw amazon api responses, and of item ids amazon rejected
+
+Responses are keyed by their operation and a normalized form of their
+parameters, so identical requests made from anywhere in the process (or,
+with a shared store, from any process) are only sent to amazon once per
+timeout.  Responses are stored zlib compressed.
+
+The store may be any object with django's cache get/set api: the default
+process local LocalStore, a django cache (settings.AMAZON_RESPONSE_CACHE),
+or a django file based cache for a local on-disk store.
+
+"""
+# stdlib imports
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from hashlib import sha1
+# local imports
+from bserial.settings import (DEFAULT_CACHE, AMAZON_RESPONSE_CACHE,
+                              AMAZON_RESPONSE_TIMEOUT,
+                              AMAZON_RESPONSE_CACHE_SIZE,
+                              AMAZON_NEGATIVE_CACHE, AMAZON_NEGATIVE_TIMEOUT)
+
+
+
+
+class LocalStore(object):
+    """
+    Thread safe, size bounded LRU store with per-entry expiry
+
+    """
+    def __init__(self, max_entries=1000, clock=time.time):
+        self.max_entries = max_entries
+        self.clock = clock
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                expires, value = self.entries.pop(key)
+            except KeyError:
+                return default
+            if expires is not None and expires <= self.clock():
+                return default
+            # re-insert as most recently used
+            self.entries[key] = (expires, value)
+            return value
+
+    def set(self, key, value, timeout=None):
+        expires = self.clock() + timeout if timeout else None
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (expires, value)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def __len__(self):
+        return len(self.entries)
+
+
+
+
+def _decode(value):
+    """value as unicode, decoding byte strings as utf-8"""
+    if isinstance(value, str):
+        return value.decode("utf-8")
+    return unicode(value)
+
+
+def _normalize(value):
+    """normalize a request parameter value"""
+    if isinstance(value, (list, tuple)):
+        value = u",".join(_decode(item) for item in value)
+    return u" ".join(_decode(value).split())
+
+
+class ResponseCache(object):
+    """
+    Compressed raw responses, keyed by operation and normalized parameters
+
+    Arguments:
+    ----------
+    0   store       object with django's cache get/set api
+    1   timeout     seconds responses stay cached
+
+    """
+    def __init__(self, store, timeout):
+        self.store = store
+        self.timeout = timeout
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def key(self, operation, params):
+        """cache key of a request"""
+        normalized = sorted((name, _normalize(value))
+                            for name, value in params.items()
+                            if value is not None)
+        digest = sha1(repr(normalized).encode("utf-8")).hexdigest()
+        return "bserial,response,%s,%s" % (operation, digest)
+
+    def get(self, operation, params):
+        """Return the cached response to a request, or None"""
+        data = self.store.get(self.key(operation, params))
+        with self.lock:
+            if data is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        return zlib.decompress(data)
+
+    def set(self, operation, params, response):
+        """Cache the response to a request"""
+        self.store.set(self.key(operation, params), zlib.compress(response),
+                       self.timeout)
+
+    def stats(self):
+        """Return hit and miss counts"""
+        return {"hits": self.hits, "misses": self.misses}
+
+
+
+
+class NegativeCache(object):
+    """
+    Item ids that amazon reported as invalid or missing, so that they are not
+    requested again until timeout passes
+
+    Arguments:
+    ----------
+    0   store       object with django's cache get_many/set_many api
+    1   timeout     seconds item ids stay cached
+
+    """
+    def __init__(self, store, timeout):
+        self.store = store
+        self.timeout = timeout
+
+    def key(self, item_id):
+        return "bserial,invalid,%s" % item_id
+
+    def add(self, item_ids):
+        """Remember item_ids as invalid"""
+        if item_ids:
+            self.store.set_many({self.key(item_id): True
+                                 for item_id in item_ids}, self.timeout)
+
+    def split(self, item_ids):
+        """Split item_ids into lists of (not cached, cached as invalid) ids"""
+        if not item_ids:
+            return [], []
+        invalid = self.store.get_many([self.key(item_id)
+                                       for item_id in item_ids])
+        valid_ids, invalid_ids = [], []
+        for item_id in item_ids:
+            if self.key(item_id) in invalid:
+                invalid_ids.append(item_id)
+            else:
+                valid_ids.append(item_id)
+        return valid_ids, invalid_ids
+
+
+
+
+def _default_cache():
+    if not AMAZON_RESPONSE_TIMEOUT:
+        return None
+    store = AMAZON_RESPONSE_CACHE
+    if store is None:
+        store = LocalStore(AMAZON_RESPONSE_CACHE_SIZE)
+    return ResponseCache(store, AMAZON_RESPONSE_TIMEOUT)
+
+_response_cache = [_default_cache()]
+
+
+def _default_negative_cache():
+    if not AMAZON_NEGATIVE_TIMEOUT:
+        return None
+    return NegativeCache(AMAZON_NEGATIVE_CACHE or DEFAULT_CACHE,
+                         AMAZON_NEGATIVE_TIMEOUT)
+
+_negative_cache = [_default_negative_cache()]
+
+
+def get_response_cache():
+    """Return the shared response cache, or None if caching is disabled"""
+    return _response_cache[0]
+
+
+def set_response_cache(cache):
+    """Replace the shared response cache, returning the previous one"""
+    old, _response_cache[0] = _response_cache[0], cache
+    return old
+
+
+def get_negative_cache():
+    """Return the shared negative cache, or None if it is disabled"""
+    return _negative_cache[0]
+
+
+def set_negative_cache(cache):
+    """Replace the shared negative cache, returning the previous one"""
+    old, _negative_cache[0] = _negative_cache[0], cache
+    return old
@@ -1,17 +1,111 @@
-# 3rd party imports
-from bottlenose import Amazon
-from xml.dom.minidom import parseString
-import xpath
+# stdlib imports
+import re
+import socket
+from httplib import HTTPException
+from io import BytesIO
+from urllib2 import HTTPError, URLError
+# django imports
+from django.db import IntegrityError, transaction
 # local imports
+from bserial.client import get_client
+from bserial.engine import get_engine, engine_for, path_steps
 from bserial.models import Book
-from bserial.settings import (AMAZON_ACCESS_KEY_ID, AMAZON_SECRET_KEY,
-                               AMAZON_ASSOC_TAG)
+from bserial.responses import get_response_cache, get_negative_cache
+from bserial.throttle import get_limiter
+from bserial.util import count_write
 
 
 
 
 def _amazon():
-    return Amazon(AMAZON_ACCESS_KEY_ID, AMAZON_SECRET_KEY, AMAZON_ASSOC_TAG)
+    return get_client()
+
+
+# error codes amazon uses when it throttles requests
+THROTTLE_CODES = ("RequestThrottled", "AWS.ECommerceService.RequestThrottled")
+
+
+class AmazonError(RuntimeError):
+    """An error reported by the amazon product api"""
+    def __init__(self, code, msg):
+        super(AmazonError, self).__init__("Amazon Errror %s: %s" % (code, msg))
+        self.code = code
+        self.msg = msg
+
+
+def is_transient(error):
+    """True if a request that failed with error may succeed when retried"""
+    if isinstance(error, AmazonError):
+        return error.code in THROTTLE_CODES
+    if isinstance(error, HTTPError):
+        return error.code >= 500
+    return isinstance(error, (URLError, HTTPException, socket.error))
+
+
+
+
+def compile_selector(selector, engine=None):
+    """
+    Return a compiled xpath plan for selector.
+
+    Plans are cached per engine and selector string, so every mapping using
+    the same selector (in any interface instance) shares a single compiled
+    plan.
+
+    """
+    return get_engine(engine).compile(selector)
+
+
+# a child step, and the steps that may end a path
+_NAME_STEP = re.compile(r"^[A-Za-z_][\w.-]*$")
+_LAST_STEP = re.compile(r"^([A-Za-z_][\w.-]*|@[A-Za-z_][\w.-]*|text\(\))$")
+# the message of amazon's error for an invalid ItemId, naming it
+_INVALID_ID = re.compile(r"^\s*(\S+) is not a valid value for ItemId")
+
+
+def split_selector(selector):
+    """
+    Split a simple relative path ("SmallImage/URL") into its first step and
+    the rest of the path (None if it has a single step), or return None if
+    selector is anything more complex.
+
+    """
+    steps = selector.split("/")
+    if not _NAME_STEP.match(steps[0]):
+        return None
+    for step in steps[1:-1]:
+        if not _NAME_STEP.match(step):
+            return None
+    if len(steps) > 1 and not _LAST_STEP.match(steps[-1]):
+        return None
+    return steps[0], "/".join(steps[1:]) or None
+
+
+def _find_in(nodes, rest):
+    """
+    selection of a path, given the nodes selected by its first step and the
+    rest of the path
+
+    """
+    if rest is None:
+        return list(nodes)
+    out = []
+    for node in nodes:
+        out.extend(engine_for(node).compile(rest).find(node))
+    return out
+
+
+def _first(nodes, rest, method):
+    """
+    findvalue()/findnode() result of a path, given the nodes selected by its
+    first step and the rest of the path
+
+    """
+    for node in nodes:
+        result = getattr(engine_for(node).compile(rest or "."), method)(node)
+        if result is not None:
+            return result
+    return None
 
 
 
@@ -26,6 +120,19 @@ class XMLMapping(object):
         """Set up new XML Mapping"""
         super(XMLMapping, self).__init__()
         self.selector = selector
+        self._plans = {}
+
+    def get_plan(self, engine):
+        """compiled xpath plan of selector for engine, built on first use"""
+        try:
+            return self._plans[engine]
+        except KeyError:
+            return self._plans.setdefault(engine,
+                                          engine.compile(self.selector))
+
+    def plan_for(self, node):
+        """compiled xpath plan that can be evaluated against node"""
+        return self.get_plan(engine_for(node))
 
     def parse(self, node):
         """
@@ -37,9 +144,20 @@ class XMLMapping(object):
 
         """
         # retrieve xpath selection
-        selection = xpath.find(self.selector, node)
+        selection = self.plan_for(node).find(node)
         # feed into parse_selection before returning
-        out = self.parse_selection(selection)
+        return self._index(self.parse_selection(selection))
+
+    def parse_shared(self, nodes, rest):
+        """
+        same as parse, given the nodes selected by the first step of
+        selector (see split_selector) and the rest of it, so that mappings
+        starting with the same step can share one selection
+
+        """
+        return self._index(self.parse_selection(_find_in(nodes, rest)))
+
+    def _index(self, out):
         if hasattr(self, 'k'):
             try:
                 out = out[self.k]
@@ -80,7 +198,10 @@ class NodeMapping(XMLMapping):
 
     """
     def parse(self, node):
-        return xpath.findnode(self.selector, node)
+        return self.plan_for(node).findnode(node)
+
+    def parse_shared(self, nodes, rest):
+        return _first(nodes, rest, "findnode")
 
 
 
@@ -91,7 +212,10 @@ class ValueMapping(XMLMapping):
 
     """
     def parse(self, node):
-        return xpath.findvalue(self.selector, node)
+        return self.plan_for(node).findvalue(node)
+
+    def parse_shared(self, nodes, rest):
+        return _first(nodes, rest, "findvalue")
 
 
 
@@ -99,7 +223,12 @@ class ValueMapping(XMLMapping):
 class BooleanMapping(XMLMapping):
     """Interprets value as boolean"""
     def parse(self, node):
-        selection = xpath.findvalue(self.selector, node)
+        return self._boolean(self.plan_for(node).findvalue(node))
+
+    def parse_shared(self, nodes, rest):
+        return self._boolean(_first(nodes, rest, "findvalue"))
+
+    def _boolean(self, selection):
         return selection.lower() in ["true", "1", 'yes', 'y']
 
 
@@ -143,31 +272,74 @@ class DictMapping(XMLMapping):
         self.attr_dict = attr_dict
 
     def parse(self, node):
-        out = []
-        items = self.item_root.parse(node)
-        for item in items:
-            attrs = {}
-            for attr in self.attr_dict:
-                value = self.attr_dict[attr].parse(item)
-                if value not in [None, [], '']:
-                    attrs[attr] = value
-            out.append(attrs)
-
+        return self._parse_items(self.item_root.parse(node))
+
+    def parse_shared(self, nodes, rest):
+        return self._parse_items(_find_in(nodes, rest))
+
+    @property
+    def selector(self):
+        return self.item_root.selector
+
+    def _parse_items(self, items):
+        k = getattr(self, "k", None)
+        if isinstance(k, int) and k >= 0:
+            # only build the dict that will be returned
+            if not items:
+                return []
+            return self._parse_item(items[k])
+        out = [self._parse_item(item) for item in items]
         if hasattr(self, "k") and out != []:
             out = out[self.k]
         return out
 
+    def _parse_item(self, item):
+        attrs = {}
+        for attr in self.attr_dict:
+            value = self.attr_dict[attr].parse(item)
+            if value not in [None, [], '']:
+                attrs[attr] = value
+        return attrs
 
 
 
 
 
+
+def _shared_split(mapping):
+    """
+    (first step, rest) of a mapping's selector if it can share the
+    selection of its first step with other mappings, otherwise None
+
+    """
+    # a subclass overriding parse may not select the way parse_shared does
+    cls = type(mapping)
+    defines = lambda name: next(c for c in cls.__mro__ if name in c.__dict__)
+    if defines("parse") is not defines("parse_shared"):
+        return None
+    if isinstance(mapping, DictMapping):
+        root = mapping.item_root
+        if type(root) is not XMLMapping or hasattr(root, "k"):
+            return None
+    return split_selector(mapping.selector)
+
+
+
+
 class XMLInterface(object):
     """
     XMLInterface can map xml documents to lists of model instances
 
     """
 
+    # class attributes that configure the interface rather than map fields
+    _options = ("model", "item_root", "map_strings", "map_default", "engine",
+                "bulk")
+    # mappings and mapping plans of each interface class (see _class_maps and
+    # mapping_plan), shared by all of its instances
+    _maps_cache = {}
+    _plans_cache = {}
+
     def __init__(self, *args, **kwargs):
         """
         Set up new XML interface objects
@@ -181,6 +353,8 @@ class XMLInterface(object):
         item_root(selector)="/"  selector for individual items
         map_strings(bool)=True   treat class strings as selectors
         map_default(class)=True  class to use for string selectors
+        engine(str)=None         xml engine name (see bserial.engine)
+        bulk(bool)=False         parse() upserts all items in bulk
 
         """
 
@@ -189,53 +363,157 @@ class XMLInterface(object):
         self.item_root      = getattr(self, "item_root", XMLMapping("/"))
         self.map_strings    = getattr(self, "map_strings", True)
         self.map_default    = getattr(self, "map_default", XMLMapping)
+        self.engine         = getattr(self, "engine", None)
+        self.bulk           = getattr(self, "bulk", False)
 
         # override with init kwargs if present
         self.model          = kwargs.get("model", self.model)
         self.item_root      = kwargs.get("item_root", self.item_root)
         self.map_strings    = kwargs.get("map_strings", self.map_strings)
         self.map_default    = kwargs.get("map_default", self.map_default)
+        self.engine         = kwargs.get("engine", self.engine)
+        self.bulk           = kwargs.get("bulk", self.bulk)
+        self.engine         = get_engine(self.engine)
+
 
+        # share the class's mappings, built once per class and options
+        maps = self._class_maps(self.map_strings, self.map_default)
+        self.__dict__.update(maps)
+        self._maps = maps
+        self._plan = None
 
+
+    @classmethod
+    def _class_maps(cls, map_strings, map_default):
+        """
+        XMLMappings defined by the class, keyed by attribute, built the
+        first time the class is used with map_strings and map_default
+
+        """
+        key = (cls, map_strings, map_default)
+        try:
+            return XMLInterface._maps_cache[key]
+        except KeyError:
+            pass
         accepted_selectors = [XMLMapping] # includes subclasses
-        if self.map_strings:
+        if map_strings:
             accepted_selectors += [str, unicode]
 
-        class_dict = self.__class__.__dict__
-        for key in class_dict:
-            # don't map private attrs
-            if not key.startswith('_'):
-                value = class_dict[key]
-                if self._is_valid_selector(value, accepted_selectors):
-                    self.set_map(key, value)
+        maps = {}
+        class_dict = cls.__dict__
+        for attr in class_dict:
+            # don't map private attrs or interface options
+            if not attr.startswith('_') and attr not in cls._options:
+                value = class_dict[attr]
+                if cls._is_valid_selector(value, accepted_selectors):
+                    maps[attr] = cls._to_mapping(value, map_default)
+        return XMLInterface._maps_cache.setdefault(key, maps)
 
 
-    def _is_valid_selector(self, selector, accepted_types):
+    @staticmethod
+    def _is_valid_selector(selector, accepted_types):
         return True in [isinstance(selector, t) for t in accepted_types]
 
 
-    def set_map(self, key, selector):
-        """Store a selector as an XMLMapping attribute"""
-        # translate strings into instance XMLMapping attributes
+    @staticmethod
+    def _to_mapping(selector, map_default):
+        # translate strings into XMLMappings
         if isinstance(selector, str) or isinstance(selector, unicode):
-            selector = self.map_default(selector)
-            setattr(self, key, selector)
-            return
-        # translate XMLMappings into instance attributes
+            return map_default(selector)
         elif isinstance(selector, XMLMapping):
-            setattr(self, key, selector)
-            return
+            return selector
         raise TypeError("Unrecognized Selector %s of type %s" % 
                         (selector, type(selector)))
 
 
+    def set_map(self, key, selector):
+        """Store a selector as an XMLMapping attribute"""
+        selector = self._to_mapping(selector, self.map_default)
+        setattr(self, key, selector)
+        # copy the class's mappings before changing them
+        self._maps = dict(self._maps)
+        self._maps[key] = selector
+        self._plan = None
+
+
     def get_maps(self):
         """Return all XMLMappings to be used in translation"""
-        return {
-                attr: selector for attr, selector in
-                [(attr, getattr(self, attr)) for attr in self.__dict__]
-                if isinstance(selector, XMLMapping) and attr != "item_root"
-        }
+        return dict(self._maps)
+
+
+    def mapping_plan(self):
+        """
+        Return the (attribute, mapping, is_unique, head, rest) tuples
+        parse_attrs walks for each item, ordered by attribute, and the list
+        of unique fields.  Mappings with a head share its selection, and
+        select rest from it (see XMLMapping.parse_shared).
+
+        Plans are computed once per interface class, options and model,
+        unless set_map changed this interface's mappings.
+
+        """
+        if self._plan is not None:
+            return self._plan
+        key = (type(self), self.map_strings, self.map_default, self.model)
+        shared = self._maps is self._class_maps(self.map_strings,
+                                                self.map_default)
+        if shared and key in self._plans_cache:
+            self._plan = self._plans_cache[key]
+            return self._plan
+        unique = [field.name for field in self.model._meta.fields
+                  if field.unique and field.name in self._maps]
+        # mappings whose selectors start with the same step share its
+        # selection (e.g. small_image and cover_sm_url share SmallImage)
+        splits = {attr: _shared_split(self._maps[attr])
+                  for attr in self._maps}
+        counts = {}
+        for split in splits.values():
+            if split is not None:
+                counts[split[0]] = counts.get(split[0], 0) + 1
+        heads = {head: XMLMapping(head)
+                 for head, count in counts.items() if count > 1}
+        steps = []
+        for attr in sorted(self._maps):
+            head = rest = None
+            if splits[attr] is not None and splits[attr][0] in heads:
+                head, rest = heads[splits[attr][0]], splits[attr][1]
+            steps.append((attr, self._maps[attr], attr in unique, head, rest))
+        self._plan = (tuple(steps), unique)
+        if shared:
+            self._plan = self._plans_cache.setdefault(key, self._plan)
+        return self._plan
+
+
+    def unique_fields(self):
+        """Return names of mapped model fields that uniquely identify a row"""
+        return list(self.mapping_plan()[1])
+
+
+    def parse_attrs(self, doc):
+        """
+        Parse the attributes of a doc that represents exactly one item into
+        a dict, without touching the database.
+
+        Unique fields are always present.  Other empty results are omitted,
+        but False values are included.
+
+        """
+        attrs = {}
+        # selections shared by several mappings, by selector
+        shared = {}
+        for key, mapping, is_unique, head, rest in self.mapping_plan()[0]:
+            # retrieve python object from parsed selector
+            if head is None:
+                result = mapping.parse(doc)
+            else:
+                try:
+                    nodes = shared[head.selector]
+                except KeyError:
+                    nodes = shared[head.selector] = head.parse(doc)
+                result = mapping.parse_shared(nodes, rest)
+            if is_unique or result not in [None, [], '']:
+                attrs[key] = result
+        return attrs
 
 
     def parse_model(self, doc):
@@ -245,28 +523,138 @@ class XMLInterface(object):
         doc should typically be an element selected by item_root
 
         """
-        # import pdb; pdb.set_trace()     #DEBUG
-        # identify unique fields in the model
-        unique_fields = [field.name for field in self.model._meta.fields
-                         if field.unique]
-        # retrieve those fields first from doc
-        attrs = self.get_maps()
-        init_kwargs = {key: attrs[key].parse(doc) for key in attrs 
-                       if key in unique_fields}
+        unique_fields = self.unique_fields()
+        attrs = self.parse_attrs(doc)
         # get_or_create new model from unique fields
+        init_kwargs = {key: attrs[key] for key in unique_fields}
         out, is_created = self.model.objects.get_or_create(**init_kwargs)
         # fill in remaining attributes
         for key in attrs:
             if key not in unique_fields:
-                # retrieve python object from parsed selector
-                result = attrs[key].parse(doc)
-                # omit empty results, but include False values
-                if result not in[None, [], '']:
-                    setattr(out, key, result)
+                setattr(out, key, attrs[key])
         return out
 
 
+    def parse_models(self, items):
+        """
+        Parse models from a list of item elements in bulk.
+
+        See upsert() for how rows are matched and written.
+
+        """
+        return self.upsert([self.parse_attrs(item) for item in items])
+
+
+    def upsert(self, rows):
+        """
+        Match attribute dicts to model instances and write them in bulk
+
+        Existing rows are fetched with a single query on the model's unique
+        field, missing rows are inserted with one bulk_create, and existing
+        rows whose field values changed are updated, all within a single
+        transaction.  If another writer inserts some of the same rows first,
+        the insert falls back on get_or_create row by row.  Attributes that
+        are not model fields are set on the returned instances only.
+
+        Returns one instance per row, in row order.  Falls back on
+        parse_model's get_or_create behaviour if the mapped model does not
+        have exactly one unique field.
+
+        """
+        unique_fields = self.unique_fields()
+        if len(unique_fields) != 1:
+            return [self._get_or_create(row, unique_fields) for row in rows]
+        key = unique_fields[0]
+        field_names = set(field.name for field in self.model._meta.fields)
+        manager = self.model.objects
+        keys = [row[key] for row in rows]
+
+        with transaction.commit_on_success(using=manager.db):
+            objs = {getattr(obj, key): obj for obj in
+                    self._untracked(manager.filter(**{key + "__in": keys}))}
+            # insert missing rows with all of their field values, merging
+            # duplicate rows so that later ones win, as for existing rows
+            new_rows = {}
+            for row in rows:
+                if row[key] not in objs:
+                    new_rows.setdefault(row[key], {}).update(row)
+            created = {}
+            for unique_value, row in new_rows.items():
+                created[unique_value] = self.model(**{
+                        name: value for name, value in row.items()
+                        if name in field_names
+                })
+            if created:
+                sid = transaction.savepoint(using=manager.db)
+                try:
+                    manager.bulk_create(created.values())
+                except IntegrityError:
+                    # another writer inserted some of these first: go row
+                    # by row, updating the rows that now exist
+                    transaction.savepoint_rollback(sid, using=manager.db)
+                    for unique_value in created.keys():
+                        defaults = {name: value for name, value in
+                                    new_rows[unique_value].items()
+                                    if name in field_names and name != key}
+                        obj, is_created = self._untracked(
+                                manager.all()).get_or_create(
+                                        defaults=defaults,
+                                        **{key: unique_value})
+                        if not is_created:
+                            del created[unique_value]
+                        objs[unique_value] = obj
+                else:
+                    transaction.savepoint_commit(sid, using=manager.db)
+                    # bulk_create does not set primary keys, so fetch them
+                    objs.update({getattr(obj, key): obj for obj in
+                                 self._untracked(manager.filter(
+                                     **{key + "__in": created.keys()}))})
+                count_write("inserted", len(created))
+            # write back changed fields of rows that already existed
+            out = []
+            for row in rows:
+                obj = objs[row[key]]
+                changed = []
+                for name, value in row.items():
+                    if name in field_names and getattr(obj, name) != value:
+                        changed.append(name)
+                    setattr(obj, name, value)
+                if row[key] not in created:
+                    if changed:
+                        obj.save(update_fields=changed)
+                        count_write("updated")
+                    else:
+                        count_write("skipped")
+                out.append(obj)
+        return out
+
+
+    def _untracked(self, qs):
+        # writes aren't reads: don't count them as accesses (bserial.access)
+        untracked = getattr(qs, "untracked", None)
+        return untracked() if untracked is not None else qs
+
+
+    def _get_or_create(self, row, unique_fields):
+        init_kwargs = {key: row[key] for key in unique_fields}
+        out, is_created = self.model.objects.get_or_create(**init_kwargs)
+        for key in row:
+            if key not in unique_fields:
+                setattr(out, key, row[key])
+        return out
+
+
+    def parse_string(self, text):
+        """Parse raw xml into a document using this interface's engine"""
+        return self.engine.parse_string(text)
+
+
     def parse(self, doc):
+        # accept raw xml as well as parsed documents
+        if isinstance(doc, basestring):
+            doc = self.parse_string(doc)
+        if self.bulk:
+            return self.parse_models(self.item_root.parse(doc))
         out = []
         # iterate through items as defined by item_root
         for item in self.item_root.parse(doc):
@@ -275,24 +663,52 @@ class XMLInterface(object):
         return out
 
 
+    def iterparse(self, stream):
+        """
+        Parse items one at a time from a file object, byte stream or string
+
+        Yields a model for every item_root element as soon as that element
+        closes, freeing processed subtrees as it goes, so memory does not
+        grow with the size of the document.  item_root must be a simple
+        absolute path (e.g. "/*/Items/Item"), and mappings should use
+        selectors relative to the item.
+
+        """
+        if isinstance(stream, unicode):
+            stream = stream.encode("utf-8")
+        if isinstance(stream, (str, bytearray)):
+            stream = BytesIO(stream)
+        steps = path_steps(self.item_root.selector)
+        for item in self.engine.iterparse(stream, steps):
+            yield self.parse_model(item)
+
+
 
 class AmazonBookInterface(XMLInterface):
     """
-    AmazonBookInterface queries Amazon Product API via bottlenose and converts
-    the response into book objects.
+    AmazonBookInterface queries Amazon Product API via bottlenose (see
+    bserial.client) and converts the response into book objects.
 
     """
 
     model       = Book
     item_root   = XMLMapping("/*/Items/Item")
     map_default = ValueMapping
+    bulk        = True
 
     # defaults
     _search_index = "KindleStore"
     _method = "lookup"
     _is_valid = BooleanMapping("/*/Items/Request/IsValid")
-    _error_code = ValueMapping("/*/Items/Request/Errors/Error/Code")
-    _error_msg = ValueMapping("/*/Items/Request/Errors/Error/Message")
+    _total_pages = ValueMapping("/*/Items/TotalPages")
+    # amazon serves at most this many ItemSearch pages
+    _max_pages = 10
+    _errors = XMLMapping("/*/Items/Request/Errors/Error")
+    _err_code = ValueMapping("Code")
+    _err_msg = ValueMapping("Message")
+    _item_error_codes = ("AWS.InvalidParameterValue",
+                         "AWS.ECommerceService.ItemNotAccessible")
+    _throttle_codes = THROTTLE_CODES
 
     # intermediate mappings
     _img_url        = ValueMapping("URL")
@@ -362,9 +778,7 @@ class AmazonBookInterface(XMLInterface):
         method(string)=lookup       what sort of query to send to amazon
 
         """
-        doc = parseString(self._get_response(*args, **kwargs))
-        self._validate(doc)
-        return super(AmazonBookInterface, self).parse(doc)
+        return self.parse_response(self._get_response(*args, **kwargs))
 
 
     def lookup(self, *args, **kwargs):
@@ -379,9 +793,8 @@ class AmazonBookInterface(XMLInterface):
         kwargs are fed directly into bottlenose
 
         """
-        doc = parseString(self._item_lookup_response(*args, **kwargs))
-        self._validate(doc)
-        return super(AmazonBookInterface, self).parse(doc)
+        response = self._item_lookup_response(*args, **kwargs)
+        return self.parse_response(response, self._lookup_ids(args, kwargs))
 
 
     def search(self, *args, **kwargs):
@@ -396,17 +809,160 @@ class AmazonBookInterface(XMLInterface):
         Keywords are fed directly into bottlenose.
 
         """
-        doc = parseString(self._item_search_response(*args, **kwargs))
-        self._validate(doc)
-        return super(AmazonBookInterface, self).parse(doc)
+        return self.parse_response(self._item_search_response(*args, **kwargs))
+
+
+    def parse_response(self, text, item_ids=None):
+        """
+        Validate a raw amazon response and parse books from it
+
+        If item_ids (the asins requested) are given and amazon rejected some
+        of them, the ones missing from the response are added to the
+        negative cache.
+
+        """
+        return self.parse_checked(self.check_response(text), item_ids)
+
+
+    def check_response(self, text):
+        """
+        Parse and validate a raw amazon response without touching the
+        database.  Raise AmazonError if amazon rejected the request, and
+        return a value for parse_checked() otherwise.
+
+        """
+        doc = self.parse_string(text)
+        return doc, self._validate(doc)
+
+
+    def parse_checked(self, checked, item_ids=None):
+        """parse books from the result of check_response()"""
+        doc, item_errors = checked
+        books = super(AmazonBookInterface, self).parse(doc)
+        self._cache_invalid(books, item_errors, item_ids)
+        return books
+
+
+    def check_rows(self, text):
+        """
+        same as check_response(), but also maps the items of the response
+        to attribute dicts, still without touching the database.  Returns a
+        value for upsert_checked().
+
+        """
+        doc, item_errors = self.check_response(text)
+        rows = [self.parse_attrs(item) for item in self.item_root.parse(doc)]
+        return rows, item_errors
+
+
+    def upsert_checked(self, checked, item_ids=None):
+        """save and return books from the result of check_rows()"""
+        rows, item_errors = checked
+        books = self.upsert(rows)
+        self._cache_invalid(books, item_errors, item_ids)
+        return books
+
+
+    def _cache_invalid(self, books, item_errors, item_ids):
+        """
+        remember the item_ids amazon's item errors name as invalid.  ItemIds
+        missing from the response for other reasons aren't remembered.
+
+        """
+        negative_cache = get_negative_cache()
+        if not item_errors or not item_ids or negative_cache is None:
+            return
+        invalid = set()
+        for code, msg in item_errors:
+            match = _INVALID_ID.match(msg or "")
+            if match:
+                invalid.add(match.group(1))
+        found = set(book.asin for book in books)
+        negative_cache.add([item_id for item_id in item_ids
+                            if item_id in invalid and item_id not in found])
+
+
+    def total_pages(self, checked):
+        """
+        number of ItemSearch pages that can be requested for the search
+        whose response check_response() returned checked
+
+        """
+        doc, item_errors = checked
+        try:
+            total = int(self._total_pages.parse(doc))
+        except (TypeError, ValueError):
+            # TotalPages is missing or not a number
+            return 1
+        return min(total, self._max_pages)
+
+
+    def _lookup_ids(self, args, kwargs):
+        """list the asins requested by lookup arguments, if they are asins"""
+        if kwargs.get("IdType", "ASIN") != "ASIN":
+            return None
+        item_ids = args[0] if args else kwargs.get("ItemId")
+        if isinstance(item_ids, basestring):
+            item_ids = item_ids.split(",")
+        return list(item_ids or [])
 
 
     def _validate(self, doc):
+        """
+        Raise AmazonError if amazon rejected the request.  Errors about
+        individual items (e.g. invalid ItemIds) don't fail the request;
+        return the (code, message) pairs of those.
+
+        """
+        errors = [(self._err_code.parse(error), self._err_msg.parse(error))
+                  for error in self._errors.parse(doc)]
+        item_errors = [(code, msg) for code, msg in errors
+                       if self._is_item_error(code, msg)]
         is_valid = self._is_valid.parse(doc)
-        if not is_valid:
-            code = self._error_code.parse(doc)
-            msg = self._error_msg.parse(doc)
-            raise RuntimeError("Amazon Errror %s: %s" % (code, msg))
+        if not is_valid and (not errors or len(item_errors) < len(errors)):
+            code, msg = ([(code, msg) for code, msg in errors
+                          if not self._is_item_error(code, msg)] or
+                         [(None, None)])[0]
+            if code in self._throttle_codes:
+                get_limiter().throttled()
+            raise AmazonError(code, msg)
+        return item_errors
+
+
+    def _is_item_error(self, code, msg):
+        """True if an error is about an individual ItemId"""
+        if code == "AWS.InvalidParameterValue":
+            return "ItemId" in (msg or "")
+        return code in self._item_error_codes
+
+
+    def _call(self, operation, **kwargs):
+        """
+        send an api request, within the shared rate limit, unless the
+        response cache already has an answer to it
+
+        """
+        cache = get_response_cache()
+        if cache is not None:
+            response = cache.get(operation, kwargs)
+            if response is not None:
+                return response
+        limiter = get_limiter()
+        limiter.acquire()
+        try:
+            response = getattr(_amazon(), operation)(**kwargs)
+        except HTTPError as e:
+            # amazon answers throttled requests with 503 Service Unavailable
+            if e.code == 503:
+                limiter.throttled()
+            raise
+        if "<IsValid>True</IsValid>" in response:
+            # only requests actually sent count towards speeding back up
+            limiter.succeeded()
+            # only cache valid responses
+            if cache is not None:
+                cache.set(operation, kwargs, response)
+        return response
 
 
     def _get_response(self, *args, **kwargs):
@@ -435,7 +991,7 @@ class AmazonBookInterface(XMLInterface):
             else:
                 raise RuntimeError("Cannot have keyword ResponseGroup AND " + 
                                    "provide a second argument")
-        return _amazon().ItemLookup(**kwargs)
+        return self._call("ItemLookup", **kwargs)
 
 
     def _item_search_response(self, *args, **kwargs):
@@ -456,4 +1012,4 @@ class AmazonBookInterface(XMLInterface):
             else:
                 raise RuntimeError("Cannot have keyword ResponseGroup AND " + 
                                    "provide a second argument")
-        return _amazon().ItemSearch(**kwargs)
+        return self._call("ItemSearch", **kwargs)
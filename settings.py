@@ -3,6 +3,23 @@ from django.core.cache import cache
 
 # Cache to be used by default when storing models with additional attributes
 DEFAULT_CACHE = getattr(settings, 'DEFAULT_CACHE', cache)
+# Prepended to model cache keys; change it to invalidate all cached models
+MODEL_CACHE_NAMESPACE = getattr(settings, 'MODEL_CACHE_NAMESPACE', None)
+# Models kept in a process local LRU in front of DEFAULT_CACHE (0 disables
+# the local tier), and seconds they stay there
+MODEL_CACHE_LOCAL_SIZE = getattr(settings, 'MODEL_CACHE_LOCAL_SIZE', 0)
+MODEL_CACHE_LOCAL_TIMEOUT = getattr(settings, 'MODEL_CACHE_LOCAL_TIMEOUT',
+                                    5)
+# Cached models packed into more bytes than this are compressed (None never
+# compresses)
+MODEL_CACHE_COMPRESS_THRESHOLD = getattr(
+        settings, 'MODEL_CACHE_COMPRESS_THRESHOLD', 1024)
+# Fraction of reads of models with an access_count field that are counted
+# (0 disables access tracking), seconds between writes of the counts, and
+# most distinct models counted between writes
+ACCESS_SAMPLE_RATE = getattr(settings, 'ACCESS_SAMPLE_RATE', 0.05)
+ACCESS_FLUSH_INTERVAL = getattr(settings, 'ACCESS_FLUSH_INTERVAL', 60)
+ACCESS_MAX_PENDING = getattr(settings, 'ACCESS_MAX_PENDING', 10000)
 
 AMAZON_ACCESS_KEY_ID = getattr(
         settings,
@@ -19,3 +36,42 @@ AMAZON_ASSOC_TAG = getattr(
         'AMAZON_ASSOC_TAG',
         None
 )
+# Scheme and host to send api requests to instead of amazon's (for local
+# stand-ins), e.g. "http://localhost:8000"
+AMAZON_ENDPOINT = getattr(settings, 'AMAZON_ENDPOINT', None)
+# Idle keep-alive connections kept per host, and socket timeout in seconds
+AMAZON_POOL_SIZE = getattr(settings, 'AMAZON_POOL_SIZE', 10)
+AMAZON_TIMEOUT = getattr(settings, 'AMAZON_TIMEOUT', None)
+
+# XML engine used by XMLInterface ("lxml" or "minidom"). None picks lxml
+# when it is installed and falls back on minidom otherwise.
+XML_ENGINE = getattr(settings, 'XML_ENGINE', None)
+
+# Number of amazon requests batch_lookup sends at the same time
+AMAZON_CONCURRENCY = getattr(settings, 'AMAZON_CONCURRENCY', 1)
+
+# Requests per second sent to amazon by the whole process (None for no limit)
+# and how many may be sent at once after a quiet period. The rate backs off
+# automatically while amazon reports throttling.
+AMAZON_RATE_LIMIT = getattr(settings, 'AMAZON_RATE_LIMIT', 1.0)
+AMAZON_RATE_BURST = getattr(settings, 'AMAZON_RATE_BURST', 1)
+
+# Seconds raw amazon responses are cached for (0 disables response caching),
+# the cache they are stored in (None for a process local LRU) and the size
+# of that LRU
+AMAZON_RESPONSE_TIMEOUT = getattr(settings, 'AMAZON_RESPONSE_TIMEOUT', 0)
+AMAZON_RESPONSE_CACHE = getattr(settings, 'AMAZON_RESPONSE_CACHE', None)
+AMAZON_RESPONSE_CACHE_SIZE = getattr(settings, 'AMAZON_RESPONSE_CACHE_SIZE',
+                                     1000)
+
+# Seconds item ids amazon reported as invalid are skipped by lookups (0
+# disables negative caching), and the cache they are stored in (None for
+# DEFAULT_CACHE)
+AMAZON_NEGATIVE_TIMEOUT = getattr(settings, 'AMAZON_NEGATIVE_TIMEOUT', 600)
+AMAZON_NEGATIVE_CACHE = getattr(settings, 'AMAZON_NEGATIVE_CACHE', None)
+
+# Times batch lookups retry a chunk after a transient error (throttling,
+# server errors, network errors), and the base of their exponential backoff
+# in seconds
+AMAZON_RETRIES = getattr(settings, 'AMAZON_RETRIES', 3)
+AMAZON_RETRY_BACKOFF = getattr(settings, 'AMAZON_RETRY_BACKOFF', 1.0)
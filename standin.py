@@ -0,0 +1,151 @@
+"""
+Local stand-in for the amazon product api, for tests and benchmarks
+
+StandInServer answers ItemLookup requests with generated items for the
+requested ItemIds, over keep-alive HTTP/1.1 connections.
+
+    >>> server = StandInServer().start()
+    >>> client = get_client("key", "secret", "tag", server.url)
+    >>> client.ItemLookup(ItemId="0000000001")
+    >>> server.stop()
+
+"""
+# stdlib imports
+import threading
+import time
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+from urlparse import urlsplit, parse_qs
+
+
+ITEM_XML = """
+    <Item>
+      <ASIN>%(asin)s</ASIN>
+      <DetailPageURL>http://www.amazon.com/dp/%(asin)s</DetailPageURL>
+      <ItemAttributes>
+        <Author>Author of %(asin)s</Author>
+        <Title>Title of %(asin)s</Title>
+      </ItemAttributes>
+    </Item>"""
+
+ERROR_XML = """
+        <Error>
+          <Code>AWS.InvalidParameterValue</Code>
+          <Message>%s is not a valid value for ItemId.</Message>
+        </Error>"""
+
+LOOKUP_XML = """<?xml version="1.0" ?>
+<ItemLookupResponse
+    xmlns="http://webservices.amazon.com/AWSECommerceService/2011-08-01">
+  <Items>
+    <Request>
+      <IsValid>True</IsValid>%s
+    </Request>%s
+  </Items>
+</ItemLookupResponse>"""
+
+
+SEARCH_XML = """<?xml version="1.0" ?>
+<ItemSearchResponse
+    xmlns="http://webservices.amazon.com/AWSECommerceService/2011-08-01">
+  <Items>
+    <Request>
+      <IsValid>True</IsValid>
+    </Request>
+    <TotalResults>%s</TotalResults>
+    <TotalPages>%s</TotalPages>%s
+  </Items>
+</ItemSearchResponse>"""
+
+
+def lookup_response(item_ids, invalid_ids=()):
+    """
+    build an amazon ItemLookup response for item_ids, with errors for any
+    of them that are in invalid_ids
+
+    """
+    errors = "".join(ERROR_XML % asin for asin in item_ids
+                     if asin in invalid_ids)
+    if errors:
+        errors = "\n      <Errors>%s\n      </Errors>" % errors
+    items = "".join(ITEM_XML % {"asin": asin} for asin in item_ids
+                    if asin not in invalid_ids)
+    return LOOKUP_XML % (errors, items)
+
+
+def search_response(page, total_results, per_page=10):
+    """
+    build page (counting from 1) of an amazon ItemSearch response with
+    total_results generated items, numbered from 0
+
+    """
+    total_pages = (total_results + per_page - 1) // per_page
+    first = (page - 1) * per_page
+    items = "".join(ITEM_XML % {"asin": "S%09d" % i}
+                    for i in xrange(first, min(first + per_page,
+                                               total_results)))
+    return SEARCH_XML % (total_results, total_pages, items)
+
+
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        with self.server.lock:
+            self.server.requests += 1
+            self.server.active += 1
+            self.server.max_active = max(self.server.max_active,
+                                         self.server.active)
+        try:
+            if self.server.delay:
+                time.sleep(self.server.delay)
+        finally:
+            with self.server.lock:
+                self.server.active -= 1
+        query = parse_qs(urlsplit(self.path).query)
+        body = lookup_response(query.get("ItemId", [""])[0].split(","))
+        self.send_response(200)
+        self.send_header("Content-Type", "text/xml; charset=UTF-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        self.server.connections += 1
+
+    def log_message(self, *args):
+        pass
+
+
+
+
+class StandInServer(ThreadingMixIn, HTTPServer):
+    """threaded http server on a free local port"""
+    daemon_threads = True
+
+    def __init__(self, delay=0):
+        HTTPServer.__init__(self, ("127.0.0.1", 0), StandInHandler)
+        self.delay = delay
+        self.requests = 0
+        self.connections = 0
+        # requests being handled at the same time, and the most there were
+        self.active = 0
+        self.max_active = 0
+        self.lock = threading.Lock()
+
+    @property
+    def url(self):
+        return "http://%s:%s" % self.server_address
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
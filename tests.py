@@ -5,7 +5,61 @@ when you run "manage.py test".
 Replace this with more appropriate tests for your application.
 """
 
+# stdlib imports
+import cPickle as pickle
+import itertools
+import os
+import shutil
+import tempfile
+import threading
+import time
+from datetime import timedelta
+from multiprocessing import TimeoutError
+from multiprocessing.pool import ThreadPool
+from StringIO import StringIO
+from urllib2 import HTTPError
+from xml.dom.minidom import parseString
+# django imports
+from django.contrib.contenttypes.models import ContentType
+from django.core.cache import get_cache
+from django.core.management import call_command
 from django.test import TestCase
+from django.utils import timezone
+from django.utils.unittest import skipUnless
+# local imports
+from bserial.engine import etree, get_engine
+from bserial import query, serial
+from bserial.models import Book
+from bserial.access import AccessTracker, set_tracker, warm_cache
+from bserial.client import AmazonClient, get_client
+from bserial.flight import SingleFlight
+from bserial.management.commands.import_books import parse_file
+from bserial.management.commands.refresh_books import refresh, stale_books
+from bserial.query import BatchResult, CacheQuerySet
+from bserial.responses import (LocalStore, ResponseCache, NegativeCache,
+                               get_negative_cache, set_response_cache,
+                               set_negative_cache)
+from bserial.standin import (StandInServer, lookup_response,
+                             search_response)
+from bserial.throttle import TokenBucket, set_limiter
+from bserial.tiered import TieredCache, set_model_cache
+from bserial.util import (merge_objects, merge_into, get_cache_key,
+                          get_cache_keys, set_cache_namespace, pack_object,
+                          unpack_object, PACK_VERSION, write_stats)
+from bserial.workers import set_pool
+from bserial.serial import (XMLMapping, ValueMapping, XMLInterface,
+                            AmazonBookInterface, AmazonError, DictMapping,
+                            compile_selector, split_selector)
+
+
+TESTDATA = os.path.join(os.path.dirname(__file__), "testdata")
+# recorded amazon responses that contain items
+RECORDED = ["item_lookup.xml", "item_search.xml"]
+
+
+def recorded_response(name="item_lookup.xml"):
+    with open(os.path.join(TESTDATA, name)) as f:
+        return f.read()
 
 
 class SimpleTest(TestCase):
@@ -15,8 +69,1099 @@ class SimpleTest(TestCase):
         """
         self.assertEqual(1 + 1, 2)
 
+class XMLMappingTest(TestCase):
+    def test_plans_are_shared_per_selector(self):
+        engine = get_engine("minidom")
+        a = ValueMapping("ItemAttributes/Title")
+        b = XMLMapping("ItemAttributes/Title")
+        self.assertTrue(a.get_plan(engine) is b.get_plan(engine))
+        self.assertTrue(a.get_plan(engine) is
+                        compile_selector("ItemAttributes/Title", engine))
+
+    def test_compiled_plan_parse(self):
+        doc = parseString(recorded_response())
+        items = XMLMapping("/*/Items/Item").parse(doc)
+        self.assertEqual(len(items), 2)
+        self.assertEqual(ValueMapping("ASIN").parse(items[0]), "B000FC1PJI")
+
+
+@skipUnless(etree, "lxml is not installed")
+class EngineParityTest(TestCase):
+    """minidom and lxml engines must produce identical books"""
+
+    def parse(self, name, engine):
+        interface = AmazonBookInterface(engine=engine)
+        books = XMLInterface.parse(interface, recorded_response(name))
+        return [{attr: getattr(book, attr, None)
+                 for attr in interface.get_maps()} for book in books]
+
+    def test_recorded_responses(self):
+        for name in RECORDED:
+            minidom_books = self.parse(name, "minidom")
+            lxml_books = self.parse(name, "lxml")
+            self.assertTrue(minidom_books)
+            self.assertEqual(minidom_books, lxml_books)
+
+    def test_external_entities_not_resolved(self):
+        engine = get_engine("lxml")
+        with tempfile.NamedTemporaryFile() as secret:
+            secret.write("secret")
+            secret.flush()
+            xml = ('<!DOCTYPE a [<!ENTITY e SYSTEM "file://%s">]>'
+                   '<a><b>&e;</b></a>' % secret.name)
+            doc = engine.parse_string(xml)
+            self.assertFalse("secret" in etree.tostring(doc))
+            b, = engine.iterparse(StringIO(xml), ["a", "b"])
+            self.assertFalse("secret" in etree.tostring(b))
+
+
 class XMLInterfaceTest(TestCase):
-    pass
+    def test_mapping_plan_is_shared(self):
+        a, b = AmazonBookInterface(), AmazonBookInterface()
+        self.assertTrue(a.title is b.title)
+        self.assertTrue(a.mapping_plan() is b.mapping_plan())
+        self.assertEqual(a.unique_fields(), ["asin"])
+        steps = a.mapping_plan()[0]
+        self.assertEqual([step[0] for step in steps], sorted(a.get_maps()))
+        self.assertEqual([step[0] for step in steps if step[2]], ["asin"])
+
+    def test_shared_selections(self):
+        interface = AmazonBookInterface()
+        heads = dict((step[0], step[3] and step[3].selector)
+                     for step in interface.mapping_plan()[0])
+        self.assertEqual(heads["small_image"], "SmallImage")
+        self.assertEqual(heads["cover_sm_url"], "SmallImage")
+        self.assertEqual(heads["title"], "ItemAttributes")
+        self.assertEqual(heads["asin"], None)
+        self.assertEqual(heads["description"], None)
+        for engine in ["minidom", "lxml"] if etree else ["minidom"]:
+            interface = AmazonBookInterface(engine=engine)
+            for name in RECORDED:
+                doc = interface.parse_string(recorded_response(name))
+                for item in interface.item_root.parse(doc):
+                    unshared = {}
+                    for attr, mapping in interface.get_maps().items():
+                        value = mapping.parse(item)
+                        if value not in [None, [], '']:
+                            unshared[attr] = value
+                    self.assertEqual(interface.parse_attrs(item), unshared)
+
+    def test_split_selector(self):
+        self.assertEqual(split_selector("SmallImage/URL"),
+                         ("SmallImage", "URL"))
+        self.assertEqual(split_selector("Height/@Units"), ("Height", "@Units"))
+        self.assertEqual(split_selector("ASIN"), ("ASIN", None))
+        self.assertEqual(split_selector("/*/Items"), None)
+        self.assertEqual(split_selector("A[1]/B"), None)
+        self.assertEqual(split_selector("A/@b/c"), None)
+
+    def test_dict_mapping_first_item_only(self):
+        calls = []
+        class CountingMapping(ValueMapping):
+            def parse(self, node):
+                calls.append(node)
+                return super(CountingMapping, self).parse(node)
+        mapping = DictMapping(XMLMapping("b"), {"c": CountingMapping("c")})[0]
+        doc = parseString("<a><b><c>1</c></b><b><c>2</c></b></a>")
+        self.assertEqual(mapping.parse(doc.documentElement), {"c": "1"})
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(mapping.parse(parseString("<a/>").documentElement),
+                         [])
+
+    def test_set_map_is_per_instance(self):
+        a, b = AmazonBookInterface(), AmazonBookInterface()
+        a.set_map("title", "ItemAttributes/Author")
+        self.assertEqual(a.title.selector, "ItemAttributes/Author")
+        self.assertEqual(b.title.selector, "ItemAttributes/Title")
+        self.assertFalse(a.mapping_plan() is b.mapping_plan())
+        self.assertEqual(dict((step[0], step[1]) for step in
+                              a.mapping_plan()[0])["title"], a.title)
+
+    def test_iterparse_matches_parse(self):
+        interface = AmazonBookInterface(engine="minidom")
+        expected = [book.asin for book in
+                    XMLInterface.parse(interface, recorded_response())]
+        with open(os.path.join(TESTDATA, "item_lookup.xml"), "rb") as f:
+            streamed = [book.asin for book in interface.iterparse(f)]
+        self.assertEqual(streamed, expected)
+
+    @skipUnless(etree, "lxml is not installed")
+    def test_iterparse_lxml(self):
+        interface = AmazonBookInterface(engine="lxml")
+        books = list(interface.iterparse(recorded_response()))
+        self.assertEqual([book.title for book in books], [
+                "Breakfast of Champions: A Novel",
+                "Good Omens: The Nice and Accurate Prophecies of Agnes "
+                "Nutter, Witch"])
+
+    def test_bulk_parse_queries(self):
+        interface = AmazonBookInterface(engine="minidom")
+        xml = recorded_response()
+        # select existing, bulk insert, select inserted
+        with self.assertNumQueries(3):
+            books = XMLInterface.parse(interface, xml)
+        self.assertEqual([book.asin for book in books],
+                         ["B000FC1PJI", "B0047Y0F0K"])
+        self.assertTrue(all(book.pk for book in books))
+        self.assertEqual(Book.objects.get(asin="B0047Y0F0K").author,
+                         "Neil Gaiman,Terry Pratchett")
+        # nothing changed, so only the select
+        with self.assertNumQueries(1):
+            XMLInterface.parse(interface, xml)
+
+    def test_bulk_parse_updates_changed_rows(self):
+        Book.objects.create(asin="B000FC1PJI", title="Old Title")
+        interface = AmazonBookInterface(engine="minidom")
+        XMLInterface.parse(interface, recorded_response())
+        self.assertEqual(Book.objects.get(asin="B000FC1PJI").title,
+                         "Breakfast of Champions: A Novel")
+
+    def test_bulk_parse_concurrent_insert(self):
+        bulk_create = Book.objects.bulk_create
+        def racing_bulk_create(objs):
+            # another writer gets one of the new rows in first
+            Book.objects.create(asin="B000FC1PJI", title="Old Title")
+            return bulk_create(objs)
+        Book.objects.bulk_create = racing_bulk_create
+        try:
+            interface = AmazonBookInterface(engine="minidom")
+            books = XMLInterface.parse(interface, recorded_response())
+        finally:
+            del Book.objects.bulk_create
+        self.assertEqual([book.asin for book in books],
+                         ["B000FC1PJI", "B0047Y0F0K"])
+        self.assertTrue(all(book.pk for book in books))
+        self.assertEqual(Book.objects.count(), 2)
+        self.assertEqual(Book.objects.get(asin="B000FC1PJI").title,
+                         "Breakfast of Champions: A Novel")
+        self.assertEqual(Book.objects.get(asin="B0047Y0F0K").author,
+                         "Neil Gaiman,Terry Pratchett")
+
+    def test_iterparse_requires_simple_item_root(self):
+        interface = XMLInterface(item_root=XMLMapping("//Item"))
+        self.assertRaises(ValueError, list, interface.iterparse("<a/>"))
+
+class ImportBooksTest(TestCase):
+    def test_parse_file(self):
+        path, rows, error = parse_file(
+                os.path.join(TESTDATA, "item_lookup.xml"),
+                AmazonBookInterface(engine="minidom"))
+        self.assertEqual(error, None)
+        self.assertEqual([row["asin"] for row in rows],
+                         ["B000FC1PJI", "B0047Y0F0K"])
+
+    def test_import(self):
+        out = StringIO()
+        call_command("import_books", TESTDATA, processes=2, batch_size=3,
+                     stdout=out)
+        asins = set()
+        for name in RECORDED:
+            path, rows, error = parse_file(os.path.join(TESTDATA, name),
+                                           AmazonBookInterface())
+            asins.update(row["asin"] for row in rows)
+        self.assertEqual(set(Book.objects.values_list("asin", flat=True)),
+                         asins)
+        self.assertTrue("from %d files" % len(RECORDED) in out.getvalue())
+
+    def test_later_responses_win_for_new_books(self):
+        archive = tempfile.mkdtemp()
+        try:
+            xml = recorded_response()
+            for name, title in [("a.xml", "Older"), ("b.xml", "Newer")]:
+                with open(os.path.join(archive, name), "wb") as f:
+                    f.write(xml.replace("Breakfast of Champions: A Novel",
+                                        title))
+            call_command("import_books", archive, processes=1,
+                         batch_size=100, stdout=StringIO())
+        finally:
+            shutil.rmtree(archive)
+        self.assertEqual(Book.objects.get(asin="B000FC1PJI").title, "Newer")
+        self.assertEqual(Book.objects.count(), 2)
+
+
+class MergeObjectsTest(TestCase):
+    def setUp(self):
+        self.book = Book(pk=1, asin="0000000001", title="Fresh")
+        self.cached = Book(pk=1, asin="0000000001", title="Stale")
+        self.cached.small_image = {"url": "small.jpg"}
+
+    def test_precedence(self):
+        merged = merge_objects(self.book, self.cached)
+        self.assertEqual(merged.title, "Fresh")
+        self.assertEqual(merged.small_image, {"url": "small.jpg"})
+        merged = merge_objects(self.cached, self.book)
+        self.assertEqual(merged.title, "Stale")
+
+    def test_merge_objects_copies_first_object(self):
+        merged = merge_objects(self.book, self.cached)
+        self.assertFalse(merged is self.book)
+        self.assertFalse(merged._state is self.book._state)
+        self.assertFalse(hasattr(self.book, "small_image"))
+
+    def test_merge_into(self):
+        out = merge_into(self.book, self.cached)
+        self.assertTrue(out is self.book)
+        self.assertEqual(self.book.small_image, {"url": "small.jpg"})
+
+    def test_type_mismatch(self):
+        self.assertRaises(TypeError, merge_objects, self.book, object())
+
+
+class CacheKeyTest(TestCase):
+    def tearDown(self):
+        set_cache_namespace(None)
+
+    def test_key_matches_content_type(self):
+        ct = ContentType.objects.get_for_model(Book)
+        self.assertEqual(get_cache_key(Book(pk=7)),
+                         "%s,%s,7" % (ct.app_label, ct.name))
+
+    def test_keys_without_queries(self):
+        get_cache_key(Book(pk=1))
+        with self.assertNumQueries(0):
+            self.assertEqual(get_cache_keys([Book(pk=1), Book(pk=2)]),
+                             [get_cache_key(Book(pk=1)),
+                              get_cache_key(Book(pk=2))])
+
+    def test_namespace(self):
+        old = get_cache_key(Book(pk=1))
+        set_cache_namespace("v2")
+        self.assertEqual(get_cache_key(Book(pk=1)), "v2," + old)
+
+
+class CountingCache(object):
+    """wraps a cache backend, counting calls to each method"""
+    def __init__(self, cache):
+        self._cache = cache
+        self.calls = {}
+
+    def __getattr__(self, name):
+        method = getattr(self._cache, name)
+        def counted(*args, **kwargs):
+            self.calls[name] = self.calls.get(name, 0) + 1
+            return method(*args, **kwargs)
+        return counted
+
+
+class CacheQuerySetTest(TestCase):
+    def setUp(self):
+        self.cache = CountingCache(get_cache(
+                "django.core.cache.backends.locmem.LocMemCache"))
+        self.cache.clear()
+        self.qs = CacheQuerySet(Book, cache=self.cache)
+        for asin in ["0000000001", "0000000002", "0000000003"]:
+            book = Book.objects.create(asin=asin)
+            book.small_image = {"url": asin}
+            self.qs.cache_add(book)
+        self.cache.calls = {}
+
+    def test_cache_add_many(self):
+        books = list(Book.objects.filter(asin__in=["0000000001"]))
+        self.qs.cache_add_many(books)
+        self.assertEqual(self.cache.calls, {"get_many": 1, "set_many": 1})
+
+    def test_iteration_merges_with_one_round_trip(self):
+        books = list(self.qs.order_by("asin"))
+        self.assertEqual([book.small_image["url"] for book in books],
+                         ["0000000001", "0000000002", "0000000003"])
+        self.assertEqual(self.cache.calls, {"get_many": 1})
+
+    def test_slice_and_get_merge(self):
+        self.assertEqual(self.qs.order_by("asin")[1:3][0].small_image,
+                         {"url": "0000000002"})
+        self.assertEqual(self.qs.get(asin="0000000003").small_image,
+                         {"url": "0000000003"})
+        self.assertFalse("get" in self.cache.calls)
+
+
+class DirtyFieldsTest(TestCase):
+    def setUp(self):
+        Book.objects.create(asin="0000000001", title="Title")
+        self.book = Book.objects.get(asin="0000000001")
+        write_stats(reset=True)
+
+    def test_dirty_fields(self):
+        self.assertEqual(self.book.dirty_fields(), [])
+        self.book.title = "New Title"
+        self.book.small_image = {"url": "1"}
+        self.assertEqual(self.book.dirty_fields(), ["title"])
+        self.assertEqual(Book(asin="0000000002").dirty_fields(), None)
+
+    def test_save_dirty(self):
+        with self.assertNumQueries(0):
+            self.assertEqual(self.book.save_dirty(), 0)
+        self.book.title = "New Title"
+        with self.assertNumQueries(1):
+            self.assertEqual(self.book.save_dirty(), 1)
+        self.assertEqual(self.book.dirty_fields(), [])
+        self.assertEqual(Book.objects.get(asin="0000000001").title,
+                         "New Title")
+        self.assertEqual(write_stats(), {"inserted": 0, "updated": 1,
+                                         "skipped": 1})
+
+    def test_cache_add_skips_unchanged_rows(self):
+        qs = CacheQuerySet(Book, cache=get_cache(
+                "django.core.cache.backends.locmem.LocMemCache"))
+        self.book.small_image = {"url": "1"}
+        with self.assertNumQueries(0):
+            qs.cache_add(self.book)
+        self.assertEqual(qs.get(pk=self.book.pk).small_image, {"url": "1"})
+        self.assertEqual(write_stats()["skipped"], 1)
+
+
+class AccessTrackerTest(TestCase):
+    def setUp(self):
+        self.now = 0.0
+        self.tracker = AccessTracker(Book, sample_rate=0.5, interval=60,
+                                     background=False,
+                                     clock=lambda: self.now,
+                                     random=lambda: 0.0)
+        self._tracker = set_tracker(Book, self.tracker)
+        self.books = [Book.objects.create(asin=asin) for asin in asins(3)]
+
+    def tearDown(self):
+        set_tracker(Book, self._tracker)
+
+    def test_record_and_flush(self):
+        a, b, c = [book.pk for book in self.books]
+        with self.assertNumQueries(0):
+            self.tracker.record([a, a, b])
+        self.assertEqual(self.tracker.pending, {a: 4, b: 2})
+        # one update per distinct increment
+        with self.assertNumQueries(2):
+            self.assertEqual(self.tracker.flush(), 2)
+        self.assertEqual(list(Book.objects.order_by("pk").values_list(
+                                 "access_count", flat=True)),
+                         [4, 2, 0])
+        # flushed in bulk once the interval has passed
+        self.tracker.record([c])
+        self.now = 60
+        self.tracker.record([c])
+        self.assertEqual(self.tracker.pending, {})
+        self.assertEqual(Book.objects.get(pk=c).access_count, 4)
+
+    def test_flushes_in_background(self):
+        flushed = threading.Event()
+        threads = []
+        def flush():
+            threads.append(threading.current_thread())
+            flushed.set()
+        self.tracker.flush = flush
+        self.tracker.background = True
+        self.now = 60
+        self.tracker.record([self.books[0].pk])
+        flushed.wait(1)
+        self.assertEqual(len(threads), 1)
+        self.assertFalse(threads[0] is threading.current_thread())
+
+    def test_concurrent_readers_start_one_flush(self):
+        release = threading.Event()
+        flushes = []
+        def flush():
+            flushes.append(1)
+            release.wait(1)
+        self.tracker.flush = flush
+        self.tracker.background = True
+        self.now = 60
+        errors = []
+        def read():
+            try:
+                for i in range(50):
+                    self.tracker.record([self.books[0].pk])
+            except Exception as e:
+                errors.append(e)
+        readers = [threading.Thread(target=read) for i in range(8)]
+        for reader in readers:
+            reader.start()
+        for reader in readers:
+            reader.join()
+        release.set()
+        self.tracker.flusher.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(len(flushes), 1)
+
+    def test_sampling(self):
+        self.tracker.random = iter([0.9, 0.1]).next
+        self.tracker.record([self.books[0].pk, self.books[1].pk])
+        self.assertEqual(self.tracker.pending, {self.books[1].pk: 2})
+
+    def test_reads_are_recorded(self):
+        Book.objects.get(pk=self.books[0].pk)
+        list(Book.objects.all()[:2])
+        self.assertEqual(self.tracker.pending, {self.books[0].pk: 4,
+                                                self.books[1].pk: 2})
+        list(Book.objects.all().untracked())
+        self.assertEqual(len(self.tracker.pending), 2)
+
+    def test_warm_cache(self):
+        cache = get_cache("django.core.cache.backends.locmem.LocMemCache")
+        cache.clear()
+        old = set_model_cache(cache)
+        try:
+            Book.objects.filter(pk=self.books[2].pk).update(access_count=9)
+            Book.objects.filter(pk=self.books[0].pk).update(access_count=3)
+            self.assertEqual(warm_cache(2), 2)
+            cached = [unpack_object(cache.get(get_cache_key(book)), Book)
+                      for book in self.books]
+            self.assertEqual([book and book.asin for book in cached],
+                             ["A000000000", None, "A000000002"])
+            self.assertEqual(self.tracker.pending, {})
+        finally:
+            set_model_cache(old)
+
+
+class PackObjectTest(TestCase):
+    def setUp(self):
+        self.book = Book(pk=3, asin="0000000003", title="Title")
+        self.book.small_image = {"url": "http://example.com/3.jpg"}
+        self.book._private_cache = "dropped"
+
+    def test_round_trip(self):
+        book = unpack_object(pack_object(self.book), Book)
+        self.assertEqual((book.pk, book.asin, book.title, book.small_image),
+                         (3, "0000000003", "Title",
+                          {"url": "http://example.com/3.jpg"}))
+        self.assertFalse(book._state.adding)
+        self.assertFalse(hasattr(book, "_private_cache"))
+
+    def test_compression_threshold(self):
+        self.book.description = "x" * 2000
+        self.assertTrue(len(pack_object(self.book)) < 1000)
+        self.assertTrue(len(pack_object(self.book, threshold=None)) > 2000)
+        self.assertEqual(
+                unpack_object(pack_object(self.book), Book).description,
+                "x" * 2000)
+
+    def test_smaller_than_pickle(self):
+        self.assertTrue(len(pack_object(self.book)) <
+                        len(pickle.dumps(self.book, pickle.HIGHEST_PROTOCOL)))
+
+    def test_unknown_format_is_a_miss(self):
+        data = "p" + pickle.dumps((PACK_VERSION + 1, (), {}))
+        self.assertEqual(unpack_object(data, Book), None)
+        # as is data packed for another set of fields
+        data = "p" + pickle.dumps((PACK_VERSION, 0, (), {}))
+        self.assertEqual(unpack_object(data, Book), None)
+        # models cached unpacked are passed through
+        self.assertTrue(unpack_object(self.book, Book) is self.book)
+
+
+class TieredCacheTest(TestCase):
+    def setUp(self):
+        self.shared = CountingCache(get_cache(
+                "django.core.cache.backends.locmem.LocMemCache"))
+        self.shared.clear()
+        self.now = 0.0
+        self.cache = TieredCache(LocalStore(2, clock=lambda: self.now),
+                                 self.shared, 5)
+        self.qs = CacheQuerySet(Book, cache=self.cache)
+        self.book = Book.objects.create(asin="0000000001")
+        self.book.small_image = {"url": "1"}
+        self.qs.cache_add(self.book)
+        self.shared.calls = {}
+
+    def test_hot_reads_stay_local(self):
+        for i in range(3):
+            self.assertEqual(self.qs.get(pk=self.book.pk).small_image,
+                             {"url": "1"})
+        self.assertEqual(self.shared.calls, {})
+        self.assertEqual(self.cache.stats()["local"]["hits"], 3)
+
+    def test_local_hits_are_not_unpacked(self):
+        unpacked = []
+        def unpack(data, model):
+            unpacked.append(data)
+            return unpack_object(data, model)
+        query.unpack_object = unpack
+        try:
+            self.assertEqual(self.qs.get(pk=self.book.pk).small_image,
+                             {"url": "1"})
+            self.assertEqual(unpacked, [])
+            # only what is read from the shared tier is unpacked
+            self.now = 10
+            self.assertEqual(self.qs.get(pk=self.book.pk).small_image,
+                             {"url": "1"})
+            self.assertEqual(len(unpacked), 1)
+        finally:
+            query.unpack_object = unpack_object
+
+    def test_write_through_and_expiry(self):
+        key = get_cache_key(self.book)
+        self.assertEqual(unpack_object(self.shared.get(key), Book).small_image,
+                         {"url": "1"})
+        self.now = 10
+        self.assertEqual(self.qs.get(pk=self.book.pk).small_image,
+                         {"url": "1"})
+        stats = self.cache.stats()
+        self.assertEqual(stats["shared"]["hits"], 1)
+        self.assertEqual(stats["shared"]["ratio"], 0.5)
+
+    def test_local_copies_are_detached(self):
+        book = self.qs.get(pk=self.book.pk)
+        book.small_image = {"url": "changed"}
+        self.book.small_image = {"url": "changed too"}
+        self.assertEqual(self.qs.get(pk=self.book.pk).small_image,
+                         {"url": "1"})
+
+    def test_invalidation_hook(self):
+        written = []
+        self.cache.add_listener(written.extend)
+        self.qs.cache_add(self.book)
+        self.assertEqual(written, [get_cache_key(self.book)])
+        # another process wrote the key: evict it locally
+        self.shared.set(written[0], Book(pk=self.book.pk, asin="other"))
+        self.cache.evict(written)
+        self.assertEqual(self.cache.get(written[0]).asin, "other")
+
+
+def asins(count):
+    return ["A%09d" % i for i in xrange(count)]
+
+
+class FakeAmazon(object):
+    """
+    local stand-in for the amazon product api, recording requests and the
+    number of them handled at the same time
+
+    """
+    def __init__(self, delay=0, invalid_ids=(), failures=None,
+                 search_results=95):
+        self.delay = delay
+        self.invalid_ids = invalid_ids
+        self.search_results = search_results
+        # ItemId -> number of requests for it that fail with a 503
+        self.failures = failures or {}
+        self.requests = []
+        self.active = 0
+        self.max_active = 0
+        self.lock = threading.Lock()
+
+    def ItemLookup(self, **kwargs):
+        with self.lock:
+            self.requests.append(kwargs)
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+        try:
+            time.sleep(self.delay)
+            for item_id in kwargs["ItemId"].split(","):
+                if self.failures.get(item_id):
+                    self.failures[item_id] -= 1
+                    raise HTTPError("http://amazon", 503, "Unavailable",
+                                    {}, None)
+            return lookup_response(kwargs["ItemId"].split(","),
+                                   self.invalid_ids)
+        finally:
+            with self.lock:
+                self.active -= 1
+
+
+    def ItemSearch(self, **kwargs):
+        with self.lock:
+            self.requests.append(kwargs)
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+        try:
+            time.sleep(self.delay)
+            return search_response(int(kwargs.get("ItemPage", 1)),
+                                   self.search_results)
+        finally:
+            with self.lock:
+                self.active -= 1
+
+
+class AmazonTestCase(TestCase):
+    """replaces the bottlenose client with a FakeAmazon"""
+    delay = 0
+    invalid_ids = ()
+
+    def setUp(self):
+        self.fake = FakeAmazon(self.delay, self.invalid_ids)
+        self._amazon = serial._amazon
+        serial._amazon = lambda: self.fake
+        self._limiter = set_limiter(TokenBucket(None))
+        self._response_cache = set_response_cache(None)
+        self._negative_cache = set_negative_cache(None)
+        self._tracker = set_tracker(Book, None)
+
+    def tearDown(self):
+        serial._amazon = self._amazon
+        set_limiter(self._limiter)
+        set_response_cache(self._response_cache)
+        set_negative_cache(self._negative_cache)
+        set_tracker(Book, self._tracker)
+
 
 class AmazonBookInterfaceTest(TestCase):
     pass
+
+
+class AmazonClientTest(TestCase):
+    def setUp(self):
+        self.server = StandInServer().start()
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_registry(self):
+        a = get_client("key", "secret", "tag", self.server.url)
+        self.assertTrue(a is get_client("key", "secret", "tag",
+                                        self.server.url))
+        self.assertFalse(a is get_client("key2", "secret", "tag",
+                                         self.server.url))
+
+    def test_connections_are_reused(self):
+        client = AmazonClient("key", "secret", "tag", self.server.url)
+        for asin in asins(5):
+            self.assertTrue(asin in client.ItemLookup(ItemId=asin))
+        self.assertEqual(self.server.requests, 5)
+        self.assertEqual(self.server.connections, 1)
+
+    def test_queryset_interface_is_shared(self):
+        self.assertTrue(Book.amazon.all().amazon is Book.amazon.all().amazon)
+
+
+class RefreshBooksTest(AmazonTestCase):
+    def setUp(self):
+        super(RefreshBooksTest, self).setUp()
+        Book.objects.bulk_create([Book(asin=asin) for asin in asins(25)])
+        Book.objects.filter(asin="A000000024").update(access_count=5)
+        Book.objects.filter(asin="A000000000").update(
+                last_refreshed=timezone.now())
+        self.max_age = timedelta(hours=1)
+
+    def requested(self):
+        return sum([r["ItemId"].split(",") for r in self.fake.requests], [])
+
+    def test_budget_and_resume(self):
+        result = refresh(self.max_age, budget=1)
+        self.assertEqual(len(self.fake.requests), 1)
+        self.assertEqual(len(result.succeeded), 10)
+        # most read first, then never refreshed in order
+        self.assertEqual(self.requested()[:2], ["A000000024", "A000000001"])
+        self.assertEqual(stale_books(self.max_age).count(), 14)
+        self.assertTrue(Book.objects.get(asin="A000000024").last_refreshed)
+        # the next run picks up where this one stopped
+        refresh(self.max_age)
+        self.assertEqual(len(self.fake.requests), 3)
+        self.assertEqual(sorted(self.requested()), asins(25)[1:])
+        self.assertEqual(stale_books(self.max_age).count(), 0)
+
+    def test_budget_counts_failed_requests(self):
+        self.fake.failures = {"A000000024": 10}
+        result = refresh(self.max_age, budget=1)
+        self.assertEqual(len(self.fake.requests), 1)
+        self.assertEqual(len(result.failed), 10)
+        self.assertEqual(stale_books(self.max_age).count(), 24)
+
+    def test_window(self):
+        refresh(self.max_age, window=0, concurrency=1)
+        self.assertEqual(self.fake.requests, [])
+        self.assertEqual(stale_books(self.max_age).count(), 24)
+
+    def test_window_closes_while_chunks_fail(self):
+        self.fake.failures = dict((asin, 10) for asin in asins(25))
+        ticks = itertools.count()
+        clock = lambda: next(ticks)
+        # the clock ticks once per ItemId pulled
+        result = refresh(self.max_age, window=15, concurrency=1, clock=clock)
+        self.assertEqual(len(self.requested()), 14)
+        self.assertEqual(len(result.failed), 14)
+        self.assertEqual(stale_books(self.max_age).count(), 24)
+
+    def test_never_refreshed_first(self):
+        Book.objects.filter(asin="A000000001").update(
+                last_refreshed=timezone.now() - timedelta(days=1))
+        order = [asin for asin, refreshed in
+                 stale_books(self.max_age).values_list("asin", "refreshed")]
+        self.assertEqual(order[:2], ["A000000024", "A000000002"])
+        self.assertEqual(order[-1], "A000000001")
+
+    def test_command(self):
+        out = StringIO()
+        call_command("refresh_books", budget=2, stdout=out)
+        self.assertEqual(out.getvalue(), "refreshed 20 books, 0 skipped, "
+                                         "0 failed, 4 still stale\n")
+
+
+class SearchTest(AmazonTestCase):
+    def test_iter_search_pages(self):
+        books = list(Book.amazon.iter_search("kindle"))
+        # amazon only serves 10 pages
+        self.assertEqual(len(books), 95)
+        self.assertEqual(books[-1].asin, "S000000094")
+        self.assertEqual([r["ItemPage"] for r in self.fake.requests],
+                         range(1, 11))
+        self.assertEqual(Book.objects.count(), 95)
+
+    def test_iter_search_limit(self):
+        books = list(Book.amazon.iter_search("kindle", limit=15))
+        self.assertEqual(len(books), 15)
+        self.assertEqual(len(self.fake.requests), 2)
+        self.assertEqual(len(list(Book.amazon.iter_search("kindle",
+                                                          limit=5))), 5)
+        self.assertEqual(len(self.fake.requests), 3)
+
+    def test_iter_search_is_lazy(self):
+        books = Book.amazon.iter_search("kindle", prefetch=2)
+        self.assertEqual(self.fake.requests, [])
+        next(books)
+        books.close()
+        self.assertTrue(len(self.fake.requests) <= 3)
+
+    def test_iter_search_prefetch(self):
+        self.fake.delay = 0.05
+        books = Book.amazon.iter_search("kindle", prefetch=3)
+        self.assertEqual(len(list(books)), 95)
+        self.assertTrue(self.fake.max_active > 1)
+
+    def test_iter_search_prefetches_during_first_page(self):
+        requested = threading.Event()
+        item_search = self.fake.ItemSearch
+        def ItemSearch(**kwargs):
+            if kwargs["ItemPage"] == 4:
+                requested.set()
+            return item_search(**kwargs)
+        self.fake.ItemSearch = ItemSearch
+        books = Book.amazon.iter_search("kindle", prefetch=3)
+        for i in range(10):
+            next(books)
+        # still on page 1: pages 2 to 4 are requested without waiting for
+        # the consumer to move on
+        self.assertTrue(requested.wait(1))
+        self.assertEqual(sorted(r["ItemPage"] for r in self.fake.requests),
+                         range(1, 5))
+        books.close()
+
+    def test_total_pages_missing(self):
+        self.fake.ItemSearch = lambda **kwargs: search_response(
+                1, 5).replace("<TotalPages>1</TotalPages>", "")
+        books = list(Book.amazon.iter_search("kindle"))
+        self.assertEqual(len(books), 5)
+
+
+class AsyncLookupTest(AmazonTestCase):
+    """asynchronous lookups against a StandInServer"""
+    def setUp(self):
+        super(AsyncLookupTest, self).setUp()
+        self.server = StandInServer(delay=0.1).start()
+        client = get_client("key", "secret", "tag", self.server.url)
+        serial._amazon = lambda: client
+        self._pool = set_pool(ThreadPool(4))
+
+    def tearDown(self):
+        set_pool(self._pool).terminate()
+        self.server.stop()
+        super(AsyncLookupTest, self).tearDown()
+
+    def test_alookup(self):
+        pending = [Book.amazon.alookup(asins(3)),
+                   Book.amazon.alookup(["B000000001"]),
+                   Book.amazon.alookup(["B000000002"])]
+        books = [p.get() for p in pending]
+        # the requests overlapped
+        self.assertEqual(self.server.requests, 3)
+        self.assertTrue(self.server.max_active > 1)
+        self.assertEqual([book.asin for book in books[0]], asins(3))
+        self.assertEqual(books[1][0].title, "Title of B000000001")
+        # same books as a lookup
+        self.assertEqual([book.pk for book in Book.amazon.lookup(asins(3))],
+                         [book.pk for book in books[0]])
+        self.assertEqual(Book.objects.count(), 5)
+
+    def test_items_are_mapped_on_the_pool(self):
+        interface = Book.amazon.get_query_set().amazon
+        threads = []
+        def parse_attrs(item):
+            threads.append(threading.current_thread())
+            return type(interface).parse_attrs(interface, item)
+        interface.parse_attrs = parse_attrs
+        try:
+            books = Book.amazon.alookup(asins(3)).get()
+        finally:
+            del interface.parse_attrs
+        self.assertEqual(len(books), 3)
+        self.assertEqual(len(threads), 3)
+        self.assertFalse(threading.current_thread() in threads)
+
+    def test_abatch_lookup(self):
+        pending = Book.amazon.abatch_lookup(asins(25))
+        self.assertRaises(TimeoutError, pending.get, 0)
+        books = pending.get()
+        self.assertEqual([book.asin for book in books], asins(25))
+        self.assertEqual(books.succeeded, asins(25))
+        self.assertEqual(self.server.requests, 3)
+
+
+class ResponseCacheTest(AmazonTestCase):
+    def setUp(self):
+        super(ResponseCacheTest, self).setUp()
+        self.now = 0.0
+        self.store = LocalStore(2, clock=lambda: self.now)
+        self.cache = ResponseCache(self.store, 60)
+        set_response_cache(self.cache)
+
+    def test_normalized_keys(self):
+        self.assertEqual(
+                self.cache.key("ItemLookup", {"ItemId": ["a", "b"],
+                                              "ResponseGroup": "Medium"}),
+                self.cache.key("ItemLookup", {"ResponseGroup": " Medium",
+                                              "ItemId": "a,b"}))
+        self.assertNotEqual(self.cache.key("ItemLookup", {"ItemId": "a"}),
+                            self.cache.key("ItemSearch", {"ItemId": "a"}))
+
+    def test_utf8_byte_string_keys(self):
+        self.assertEqual(
+                self.cache.key("ItemSearch", {"Keywords": "caf\xc3\xa9",
+                                              "Author": ["G\xc3\xb6del"]}),
+                self.cache.key("ItemSearch", {"Keywords": u"caf\xe9",
+                                              "Author": u"G\xf6del"}))
+
+    def test_identical_requests_are_sent_once(self):
+        interface = AmazonBookInterface()
+        first = interface.lookup("A000000001")
+        second = interface.lookup("A000000001")
+        self.assertEqual(len(self.fake.requests), 1)
+        self.assertEqual(first[0].asin, second[0].asin)
+        self.assertEqual(self.cache.stats(), {"hits": 1, "misses": 1})
+
+    def test_hits_dont_speed_up_the_limiter(self):
+        succeeded = []
+        class CountingBucket(TokenBucket):
+            def succeeded(self):
+                succeeded.append(1)
+        set_limiter(CountingBucket(None))
+        Book.amazon.lookup("A000000001")
+        Book.amazon.lookup("A000000001")
+        self.assertEqual(len(self.fake.requests), 1)
+        self.assertEqual(len(succeeded), 1)
+
+    def test_lru_and_timeout(self):
+        self.store.set("a", 1, 10)
+        self.store.set("b", 2, 10)
+        self.store.get("a")
+        self.store.set("c", 3, 10)
+        self.assertEqual(self.store.get("b"), None)
+        self.assertEqual(self.store.get("a"), 1)
+        self.now += 11
+        self.assertEqual(self.store.get("a"), None)
+
+
+class NegativeCacheTest(AmazonTestCase):
+    invalid_ids = ("A000000001", "A000000012")
+
+    def setUp(self):
+        super(NegativeCacheTest, self).setUp()
+        self.cache = get_cache("django.core.cache.backends.locmem.LocMemCache")
+        self.cache.clear()
+        set_negative_cache(NegativeCache(self.cache, 60))
+
+    def test_partially_invalid_lookup(self):
+        books = Book.amazon.lookup(asins(3))
+        self.assertEqual([book.asin for book in books],
+                         ["A000000000", "A000000002"])
+        # the invalid asin is skipped next time
+        Book.amazon.lookup(asins(3))
+        self.assertEqual(self.fake.requests[1]["ItemId"],
+                         "A000000000,A000000002")
+        self.assertEqual(Book.amazon.lookup("A000000001"), [])
+        self.assertEqual(len(self.fake.requests), 2)
+
+    def test_only_named_ids_are_cached(self):
+        # A000000002 is missing for another reason than being invalid
+        self.fake.ItemLookup = lambda **kwargs: lookup_response(
+                ["A000000001", "B000000009"], self.invalid_ids)
+        Book.amazon.lookup(["A000000001", "A000000002"])
+        self.assertEqual(get_negative_cache().split(asins(3)),
+                         (["A000000000", "A000000002"], ["A000000001"]))
+
+    def test_batch_lookup_skips_invalid(self):
+        self.assertEqual(len(Book.amazon.batch_lookup(asins(20))), 18)
+        self.assertEqual(len(Book.amazon.batch_lookup(asins(20))), 18)
+        self.assertEqual(sum(len(r["ItemId"].split(","))
+                             for r in self.fake.requests[2:]), 18)
+
+    def test_batch_lookup_reports_skipped(self):
+        books = Book.amazon.batch_lookup(asins(15))
+        self.assertEqual(books.skipped, ["A000000001", "A000000012"])
+        self.assertEqual(len(books.succeeded), 13)
+        # skipped from the negative cache the second time
+        books = Book.amazon.batch_lookup(asins(15))
+        self.assertEqual(books.skipped, ["A000000001", "A000000012"])
+        self.assertEqual(len(self.fake.requests), 4)
+
+    def test_request_errors_still_raise(self):
+        self.fake.ItemLookup = lambda **kwargs: (
+                '<?xml version="1.0" ?><ItemLookupResponse><Items><Request>'
+                '<IsValid>False</IsValid><Errors><Error>'
+                '<Code>AWS.MissingParameters</Code><Message>Missing ItemId'
+                '</Message></Error></Errors></Request></Items>'
+                '</ItemLookupResponse>')
+        self.assertRaises(AmazonError, Book.amazon.lookup, asins(2))
+
+
+class SingleFlightTest(TestCase):
+    def setUp(self):
+        self.flight = SingleFlight()
+        self.requested = []
+
+    def fetch(self, keys):
+        self.requested.append(sorted(keys))
+        time.sleep(0.05)
+        return {key: key.upper() for key in keys if key != "missing"}
+
+    def run_concurrently(self, *key_sets):
+        results = [None] * len(key_sets)
+        def run(i, keys):
+            results[i] = self.flight.do_many(keys, self.fetch)
+        threads = [threading.Thread(target=run, args=(i, keys))
+                   for i, keys in enumerate(key_sets)]
+        for thread in threads:
+            thread.start()
+            time.sleep(0.01)
+        for thread in threads:
+            thread.join()
+        return results
+
+    def test_overlapping_keys_are_requested_once(self):
+        a, b = self.run_concurrently(["a", "b"], ["b", "c", "missing"])
+        self.assertEqual(self.requested, [["a", "b"], ["c", "missing"]])
+        self.assertEqual(a, {"a": "A", "b": "B"})
+        self.assertEqual(b, {"b": "B", "c": "C"})
+
+    def test_waiters_share_errors(self):
+        def fail(keys):
+            time.sleep(0.05)
+            raise ValueError("boom")
+        errors = []
+        def run():
+            try:
+                self.flight.do_many(["a"], fail)
+            except ValueError as e:
+                errors.append(e)
+        threads = [threading.Thread(target=run) for i in xrange(3)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(errors), 3)
+        self.assertEqual(self.flight.flights, {})
+
+
+class TokenBucketTest(TestCase):
+    def setUp(self):
+        self.now = 0.0
+        self.slept = []
+        self.bucket = TokenBucket(2.0, burst=2, clock=lambda: self.now,
+                                  sleep=self.slept.append)
+
+    def test_burst_then_rate(self):
+        self.bucket.acquire()
+        self.bucket.acquire()
+        self.assertEqual(self.slept, [])
+        self.bucket.acquire()
+        self.bucket.acquire()
+        self.assertEqual(self.slept, [0.5, 1.0])
+
+    def test_refill(self):
+        for i in xrange(3):
+            self.bucket.acquire()
+        self.now += 10
+        self.slept = []
+        self.bucket.acquire()
+        self.assertEqual(self.slept, [])
+
+    def test_adaptive_rate(self):
+        self.bucket.throttled()
+        self.bucket.throttled()
+        self.assertEqual(self.bucket.rate, 0.5)
+        for i in xrange(100):
+            self.bucket.succeeded()
+        self.assertEqual(self.bucket.rate, 2.0)
+
+    def test_unlimited(self):
+        bucket = TokenBucket(None, sleep=self.slept.append)
+        for i in xrange(10):
+            bucket.acquire()
+        bucket.throttled()
+        self.assertEqual(self.slept, [])
+
+
+class BatchLookupTest(AmazonTestCase):
+    delay = 0.05
+
+    def test_concurrent_batch_lookup(self):
+        item_ids = asins(35)
+        books = Book.amazon.batch_lookup(item_ids, concurrency=4)
+        self.assertEqual([book.asin for book in books], item_ids)
+        self.assertEqual(len(self.fake.requests), 4)
+        self.assertTrue(self.fake.max_active > 1)
+        self.assertTrue(self.fake.max_active <= 4)
+        self.assertEqual(Book.objects.count(), 35)
+
+    def test_serial_batch_lookup(self):
+        books = Book.amazon.batch_lookup(ItemId=",".join(asins(12)),
+                                         concurrency=1)
+        self.assertEqual(len(books), 12)
+        self.assertEqual(self.fake.max_active, 1)
+        self.assertEqual(self.fake.requests[1]["ItemId"], "A000000010,"
+                                                          "A000000011")
+
+    def test_positional_response_group(self):
+        books = Book.amazon.batch_lookup(asins(12), "Images")
+        self.assertEqual(books.failed, {})
+        self.assertEqual(len(books), 12)
+        self.assertEqual([r["ResponseGroup"] for r in self.fake.requests],
+                         ["Images", "Images"])
+        books = Book.amazon.abatch_lookup(asins(3), "Images").get()
+        self.assertEqual(len(books), 3)
+
+    def test_lookup_normalizes_ids(self):
+        books = Book.amazon.lookup("a000000001, A000000002")
+        self.assertEqual([book.asin for book in books],
+                         ["A000000001", "A000000002"])
+        self.assertEqual(self.fake.requests[0]["ItemId"],
+                         "A000000001,A000000002")
+
+    def test_lookup_returns_unmatched_books(self):
+        # amazon may answer with another asin than the one requested
+        self.fake.ItemLookup = lambda **kwargs: lookup_response(
+                ["A000000001", "B000000009"])
+        books = Book.amazon.lookup(["A000000001", "A000000002"])
+        self.assertEqual([book.asin for book in books],
+                         ["A000000001", "B000000009"])
+
+    def test_iter_lookup_streams_chunks(self):
+        Book.objects.bulk_create([Book(asin=asin) for asin in asins(25)])
+        books = Book.amazon.iter_lookup(concurrency=1)
+        self.assertEqual(self.fake.requests, [])
+        self.assertEqual(next(books).asin, "A000000000")
+        self.assertEqual(len(self.fake.requests), 1)
+        self.assertEqual(len(list(books)), 24)
+        self.assertEqual(len(self.fake.requests), 3)
+        self.assertEqual(Book.objects.count(), 25)
+
+    def test_transient_failures_retried(self):
+        self.fake.failures = {"A000000000": 2}
+        books = Book.amazon.batch_lookup(asins(15), backoff=0)
+        self.assertEqual(len(books), 15)
+        self.assertEqual(books.succeeded, asins(15))
+        self.assertEqual(books.failed, {})
+        self.assertEqual(len(self.fake.requests), 4)
+
+    def test_failed_chunk_isolated(self):
+        self.fake.failures = {"A000000000": 10}
+        books = Book.amazon.batch_lookup(asins(25), concurrency=2,
+                                         retries=1, backoff=0)
+        self.assertEqual([book.asin for book in books], asins(25)[10:])
+        self.assertEqual(sorted(books.failed), asins(10))
+        self.assertTrue(isinstance(books.failed["A000000000"], HTTPError))
+        self.assertEqual(Book.objects.count(), 15)
+
+    def test_iter_lookup_records_only_when_asked(self):
+        self.fake.failures = {"A000000000": 10}
+        books = list(Book.amazon.iter_lookup(asins(25), retries=0))
+        self.assertEqual([book.asin for book in books], asins(25)[10:])
+        result = BatchResult()
+        list(Book.amazon.iter_lookup(asins(25)[10:], result=result))
+        self.assertEqual(result.succeeded, asins(25)[10:])
+        self.assertEqual(list(result), [])
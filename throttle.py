@@ -0,0 +1,100 @@
+"""
+Client side rate limiting for amazon api requests
+
+Every AmazonBookInterface in the process draws from the same TokenBucket
+(see get_limiter), so the total request rate stays within the configured
+limit no matter how many querysets, threads or batch lookups are running.
+
+"""
+# stdlib imports
+import threading
+import time
+# local imports
+from bserial.settings import AMAZON_RATE_LIMIT, AMAZON_RATE_BURST
+
+
+
+
+class TokenBucket(object):
+    """
+    Thread safe token bucket with an adaptive rate
+
+    Arguments:
+    ----------
+    0   rate        maximum requests per second.  None disables limiting
+    1   burst       requests that may be sent at once after a quiet period
+
+    Keywords:
+    ---------
+    min_rate(float)=rate/16     lowest rate adaptive backoff will fall to
+    backoff(float)=0.5          rate multiplier applied when throttled
+    recovery(float)=0.05        fraction of rate regained per success
+
+    The rate backs off multiplicatively whenever the api reports throttling
+    and recovers additively with every successful request, settling near the
+    highest rate the api currently allows.
+
+    """
+    def __init__(self, rate, burst=1, min_rate=None, backoff=0.5,
+                 recovery=0.05, clock=time.time, sleep=time.sleep):
+        self.max_rate = rate
+        self.rate = rate
+        self.burst = burst
+        self.min_rate = min_rate or (rate / 16.0 if rate else None)
+        self.backoff = backoff
+        self.recovery = recovery
+        self.clock = clock
+        self.sleep = sleep
+        self.tokens = float(burst)
+        self.updated = clock()
+        self.lock = threading.Lock()
+
+
+    def acquire(self):
+        """Block until a request may be sent"""
+        if not self.max_rate:
+            return
+        with self.lock:
+            now = self.clock()
+            self.tokens = min(self.burst,
+                              self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            # reserve a token, waiting outside the lock for it if in debt
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait:
+            self.sleep(wait)
+
+
+    def throttled(self):
+        """Slow down after the api reported throttling"""
+        if not self.max_rate:
+            return
+        with self.lock:
+            self.rate = max(self.min_rate, self.rate * self.backoff)
+            self.tokens = min(self.tokens, 0)
+
+
+    def succeeded(self):
+        """Speed back up towards max_rate after a successful request"""
+        if not self.max_rate or self.rate >= self.max_rate:
+            return
+        with self.lock:
+            self.rate = min(self.max_rate,
+                            self.rate + self.max_rate * self.recovery)
+
+
+
+
+_limiter = [TokenBucket(AMAZON_RATE_LIMIT, AMAZON_RATE_BURST)]
+
+
+def get_limiter():
+    """Return the rate limiter shared by all amazon requests"""
+    return _limiter[0]
+
+
+def set_limiter(limiter):
+    """Replace the shared rate limiter, returning the previous one"""
+    old, _limiter[0] = _limiter[0], limiter
+    return old
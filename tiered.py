@@ -0,0 +1,180 @@
+"""
+Two tier model cache: a process local LRU in front of a shared django cache
+
+Hot models are served from the local tier without a network round trip or
+unpickling: values are kept there as objects, and only packed (see
+bserial.util.pack_object) for the shared tier.  Writes go through to both
+tiers.  Entries only live in the
+local tier for a few seconds, so other processes' writes are seen soon;
+listeners added with add_listener() are told which keys were written, e.g.
+to broadcast them so other processes can evict() them at once.
+
+"""
+# stdlib imports
+import threading
+# local imports
+from bserial.responses import LocalStore
+from bserial.settings import (DEFAULT_CACHE, MODEL_CACHE_LOCAL_SIZE,
+                              MODEL_CACHE_LOCAL_TIMEOUT)
+from bserial.util import copy_object
+
+
+def _detach(value):
+    """copy objects, so the local tier never shares them with callers"""
+    if hasattr(value, "__dict__"):
+        return copy_object(value)
+    return value
+
+
+
+
+class TieredCache(object):
+    """
+    Django cache api over a local store and a shared cache
+
+    Arguments:
+    ----------
+    0   local           LocalStore (or other get/set store) for hot entries
+    1   shared          django cache shared between processes
+    2   local_timeout   seconds entries stay in the local tier
+
+    """
+    def __init__(self, local, shared, local_timeout=MODEL_CACHE_LOCAL_TIMEOUT):
+        self.local = local
+        self.shared = shared
+        self.local_timeout = local_timeout
+        self.listeners = []
+        self.counts = {"local": [0, 0], "shared": [0, 0]}
+        self.lock = threading.Lock()
+
+
+    def _count(self, tier, hits, misses):
+        with self.lock:
+            self.counts[tier][0] += hits
+            self.counts[tier][1] += misses
+
+
+    def _local_timeout(self, timeout):
+        if timeout:
+            return min(timeout, self.local_timeout)
+        return self.local_timeout
+
+
+    def get(self, key, default=None, unpack=None):
+        return self.get_many([key], unpack).get(key, default)
+
+
+    def get_many(self, keys, unpack=None):
+        """
+        Return a dict of cached values for keys.  unpack, if given, converts
+        values read from the shared tier (see set_many), and may return
+        None for values that can't be used.
+
+        """
+        out, missing = {}, []
+        for key in keys:
+            value = self.local.get(key)
+            if value is None:
+                missing.append(key)
+            else:
+                out[key] = _detach(value)
+        self._count("local", len(out), len(missing))
+        if missing:
+            found = self.shared.get_many(missing)
+            self._count("shared", len(found), len(missing) - len(found))
+            for key, value in found.items():
+                if unpack is not None:
+                    value = unpack(value)
+                    if value is None:
+                        continue
+                self.local.set(key, _detach(value), self.local_timeout)
+                out[key] = value
+        return out
+
+
+    def set(self, key, value, timeout=None, pack=None):
+        self.set_many({key: value}, timeout, pack)
+
+
+    def set_many(self, data, timeout=None, pack=None):
+        """
+        Cache data in both tiers.  pack, if given, converts values for the
+        shared tier only (e.g. serializes them); the local tier keeps
+        values as they are, so local hits don't pay for unpacking.
+
+        """
+        if pack is None:
+            self.shared.set_many(data, timeout)
+        else:
+            self.shared.set_many({key: pack(value)
+                                  for key, value in data.items()}, timeout)
+        local_timeout = self._local_timeout(timeout)
+        for key, value in data.items():
+            self.local.set(key, _detach(value), local_timeout)
+        self._notify(data.keys())
+
+
+    def delete(self, key):
+        self.delete_many([key])
+
+
+    def delete_many(self, keys):
+        self.shared.delete_many(keys)
+        self.evict(keys)
+        self._notify(keys)
+
+
+    def clear(self):
+        self.shared.clear()
+        self.local.clear()
+
+
+    def evict(self, keys):
+        """drop keys from the local tier only, e.g. when another process
+        wrote them"""
+        for key in keys:
+            self.local.delete(key)
+
+
+    def add_listener(self, listener):
+        """call listener with the list of keys whenever keys are written"""
+        self.listeners.append(listener)
+
+
+    def _notify(self, keys):
+        keys = list(keys)
+        for listener in self.listeners:
+            listener(keys)
+
+
+    def stats(self):
+        """Return hit and miss counts, and hit ratios, of each tier"""
+        out = {}
+        with self.lock:
+            for tier, (hits, misses) in self.counts.items():
+                total = hits + misses
+                out[tier] = {"hits": hits, "misses": misses,
+                             "ratio": float(hits) / total if total else 0.0}
+        return out
+
+
+
+
+def _default_cache():
+    if not MODEL_CACHE_LOCAL_SIZE:
+        return DEFAULT_CACHE
+    return TieredCache(LocalStore(MODEL_CACHE_LOCAL_SIZE), DEFAULT_CACHE,
+                       MODEL_CACHE_LOCAL_TIMEOUT)
+
+_model_cache = [_default_cache()]
+
+
+def get_model_cache():
+    """Return the cache models are stored in by default"""
+    return _model_cache[0]
+
+
+def set_model_cache(cache):
+    """Replace the default model cache, returning the previous one"""
+    old, _model_cache[0] = _model_cache[0], cache
+    return old
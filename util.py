@@ -3,34 +3,314 @@ Utility objects and methods for BreakfastSerial
 
 """
 # stdlib imports
-from copy import deepcopy
-# django imports
-from django.contrib.contenttypes.models import ContentType
+import cPickle as pickle
+import threading
+import zlib
+from copy import copy
+from itertools import islice
+# local imports
+from bserial.settings import (MODEL_CACHE_NAMESPACE,
+                              MODEL_CACHE_COMPRESS_THRESHOLD)
+
+# names every instance of a class has, keyed by class
+_class_attr_cache = {}
+
+
+def _class_attrs(cls):
+    """
+    names that every instance of cls has, whether or not they are set in the
+    instance __dict__ (class attributes, and concrete fields of models)
+
+    """
+    try:
+        return _class_attr_cache[cls]
+    except KeyError:
+        names = set(dir(cls))
+        meta = getattr(cls, "_meta", None)
+        if meta is not None:
+            names.update(field.attname for field in meta.fields)
+        return _class_attr_cache.setdefault(cls, frozenset(names))
+
+
+def copy_object(obj):
+    """
+    Return a shallow copy of obj without going through pickling machinery
+
+    Attribute values are shared with obj, except for a django model's
+    _state, which is copied so the two instances can be saved separately.
+
+    """
+    out = obj.__class__.__new__(obj.__class__)
+    out.__dict__.update(obj.__dict__)
+    state = obj.__dict__.get("_state")
+    if state is not None:
+        out._state = copy(state)
+    return out
+
+
+def chunked(iterable, size):
+    """yield lists of up to size items from iterable, consuming it lazily"""
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def merge_into(tgt, *args):
+    """
+    Merge the attributes of objects in args into tgt, in place, and return
+    tgt.
+
+    Attributes tgt already has take precedence, followed by objects listed
+    first in args.  All objects must be the same type.
+
+    """
+    tgt_type = type(tgt)
+    known = _class_attrs(tgt_type)
+    tgt_dict = tgt.__dict__
+    for src in args:
+        if not isinstance(src, tgt_type):
+            raise TypeError("%s is not of the type %s" % (src, tgt_type))
+        for property, value in src.__dict__.items():
+            # skip methods, and anything tgt already has
+            if (property not in tgt_dict and property not in known and
+                    not callable(value)):
+                tgt_dict[property] = value
+    return tgt
+
 
 def merge_objects(*args):
     """
     Take a list of objects and merge their attributes.
 
     Objects listed first take precedence over objects listed after.  All
-    objects must be the same type.
+    objects must be the same type.  The first object is copied (see
+    copy_object) rather than modified; use merge_into to merge in place.
 
     """
     if len(args) < 2:
         raise ValueError("Must provide at least two objects in arguments")
-    tgt = deepcopy(args[0])
-    for src in args[1:]:
-        if not isinstance(src, type(tgt)):
-            raise TypeError("%s is not of the type %s" % (src, type(tgt)))
-        for property in src.__dict__:
-            # check to make sure it can't be called (a method)
-            # also check that tgt doesn't have a property of the same name
-            if (not callable(src.__dict__[property]) and
-                    not hasattr(tgt, property)):
-                setattr(tgt, property, getattr(src, property))
-    return tgt
+    return merge_into(copy_object(args[0]), *args[1:])
+
+# cache key prefixes, keyed by model class
+_key_prefixes = {}
+# prepended to every cache key (see set_cache_namespace)
+_namespace = [MODEL_CACHE_NAMESPACE]
+
+
+def set_cache_namespace(namespace):
+    """
+    Prefix all model cache keys with namespace from now on.
+
+    Changing the namespace invalidates everything cached under the old one.
+
+    """
+    _namespace[0] = namespace
+    _key_prefixes.clear()
+
+
+def _key_prefix(model):
+    """cache key prefix of a model class, computed once per class"""
+    try:
+        return _key_prefixes[model]
+    except KeyError:
+        # match ContentType's app_label and name, using the concrete model
+        # for proxy and deferred classes
+        opts = model._meta
+        opts = getattr(opts, "concrete_model", model)._meta
+        prefix = "%s,%s" % (opts.app_label, opts.verbose_name_raw)
+        if _namespace[0] is not None:
+            prefix = "%s,%s" % (_namespace[0], prefix)
+        return _key_prefixes.setdefault(model, prefix)
+
 
 def get_cache_key(obj):
     """construct the cache key of an appropriate object"""
     # use comma separator, as it's an illegal character in class name
-    ct = ContentType.objects.get_for_model(obj)
-    return "%s,%s,%s" % (ct.app_label, ct.name, obj.pk)
+    return "%s,%s" % (_key_prefix(type(obj)), obj.pk)
+
+
+def get_cache_keys(objs):
+    """construct the cache keys of a list of objects, in order"""
+    return ["%s,%s" % (_key_prefix(type(obj)), obj.pk) for obj in objs]
+
+
+
+# version of the packed model format; bump it when the format changes
+PACK_VERSION = 2
+# first byte of packed models: plain or zlib compressed
+_PLAIN, _COMPRESSED = "p", "z"
+# concrete field attnames, and their checksums, keyed by model class
+_field_names = {}
+_schemas = {}
+
+
+def _fields(model):
+    """attnames of a model's concrete fields, in order"""
+    try:
+        return _field_names[model]
+    except KeyError:
+        opts = model._meta
+        opts = getattr(opts, "concrete_model", model)._meta
+        names = tuple(field.attname for field in opts.fields)
+        return _field_names.setdefault(model, names)
+
+
+def _schema(model):
+    """checksum of a model's field attnames, to tell field changes apart"""
+    try:
+        return _schemas[model]
+    except KeyError:
+        schema = zlib.crc32(",".join(_fields(model))) & 0xffffffff
+        return _schemas.setdefault(model, schema)
+
+
+def pack_object(obj, threshold=MODEL_CACHE_COMPRESS_THRESHOLD):
+    """
+    Pack a model instance into a compact string for caching
+
+    Only field values and public extra attributes (e.g. small_image) are
+    kept, as a pickled tuple rather than a pickled model, and compressed if
+    longer than threshold bytes (None never compresses).  A checksum of the
+    field names is kept too, so that values aren't read back into the
+    wrong fields once the model changes.
+
+    """
+    names = _fields(type(obj))
+    known = set(names)
+    extras = {name: value for name, value in obj.__dict__.items()
+              if name not in known and not name.startswith("_")}
+    data = pickle.dumps((PACK_VERSION, _schema(type(obj)),
+                         tuple(getattr(obj, name) for name in names),
+                         extras), pickle.HIGHEST_PROTOCOL)
+    if threshold is not None and len(data) > threshold:
+        return _COMPRESSED + zlib.compress(data)
+    return _PLAIN + data
+
+
+def unpack_object(data, model):
+    """
+    Rebuild a model instance from pack_object's output
+
+    Returns None for data packed in another version of the format, or for
+    another set of fields.  Model instances cached before packing was
+    introduced are returned as is.
+
+    """
+    if not isinstance(data, str):
+        return data
+    if data[:1] == _COMPRESSED:
+        data = zlib.decompress(data[1:])
+    else:
+        data = data[1:]
+    packed = pickle.loads(data)
+    if packed[0] != PACK_VERSION:
+        return None
+    version, schema, values, extras = packed
+    if schema != _schema(model):
+        return None
+    obj = model(*values)
+    obj._state.adding = False
+    obj.__dict__.update(extras)
+    return obj
+
+
+
+# database writes made and avoided by DirtyFieldsMixin models
+_writes = {"inserted": 0, "updated": 0, "skipped": 0}
+_writes_lock = threading.Lock()
+
+
+def count_write(kind, count=1):
+    """record count database writes of kind (inserted/updated/skipped)"""
+    with _writes_lock:
+        _writes[kind] += count
+
+
+def write_stats(reset=False):
+    """
+    Return counts of rows inserted, updated and of writes skipped because
+    nothing changed, optionally resetting them.
+
+    """
+    with _writes_lock:
+        out = dict(_writes)
+        if reset:
+            for kind in _writes:
+                _writes[kind] = 0
+    return out
+
+
+
+
+class DirtyFieldsMixin(object):
+    """
+    Model mixin tracking which concrete fields changed since the instance
+    was loaded or saved, so that saves can write only those
+
+    List it before models.Model in the bases of a model.
+
+    """
+    def __init__(self, *args, **kwargs):
+        super(DirtyFieldsMixin, self).__init__(*args, **kwargs)
+        self._snapshot()
+
+
+    def _snapshot(self, names=None):
+        # read __dict__ directly, so deferred fields aren't loaded
+        values = self.__dict__
+        if names is None:
+            self._loaded_values = {name: values[name]
+                                   for name in _fields(type(self))
+                                   if name in values}
+        else:
+            loaded = dict(self._loaded_values)
+            loaded.update((name, values[name]) for name in names
+                          if name in values)
+            self._loaded_values = loaded
+
+
+    def dirty_fields(self, loaded=None):
+        """
+        List the attnames of concrete fields that changed since loaded (by
+        default this instance) was loaded from or saved to the database, or
+        return None if it has never been.
+
+        """
+        loaded = self if loaded is None else loaded
+        if loaded._state.adding or self.pk is None:
+            return None
+        before = loaded.__dict__.get("_loaded_values")
+        if before is None:
+            return None
+        values = self.__dict__
+        return [name for name in _fields(type(self))
+                if name in values and
+                (name not in before or values[name] != before[name])]
+
+
+    def save_dirty(self, loaded=None):
+        """
+        Save only the fields that changed since loaded (by default this
+        instance) was loaded, skipping the write if none did.  Returns the
+        number of fields written, or None if the whole row was.
+
+        """
+        dirty = self.dirty_fields(loaded)
+        if dirty is None:
+            adding = self._state.adding
+            self.save()
+            count_write("inserted" if adding else "updated")
+        elif dirty:
+            self.save(update_fields=dirty)
+            count_write("updated")
+        else:
+            count_write("skipped")
+        return dirty if dirty is None else len(dirty)
+
+
+    def save(self, *args, **kwargs):
+        super(DirtyFieldsMixin, self).save(*args, **kwargs)
+        self._snapshot(kwargs.get("update_fields"))
@@ -0,0 +1,88 @@
+"""
+Thread pool helpers for running blocking amazon requests concurrently
+
+"""
+# stdlib imports
+import random
+import threading
+import time
+from collections import deque
+from multiprocessing.pool import ThreadPool
+# local imports
+from bserial.settings import (AMAZON_CONCURRENCY, AMAZON_RETRIES,
+                              AMAZON_RETRY_BACKOFF)
+
+
+def bounded_imap(fn, iterable, concurrency=1):
+    """
+    Apply fn to every item of iterable on a pool of concurrency threads,
+    yielding results in input order.
+
+    Unlike ThreadPool.imap, at most concurrency items are in flight ahead of
+    the consumer, so iterable is consumed lazily and results never pile up.
+    Exceptions raised by fn are re-raised when their result is reached.
+    With a concurrency of 1 or less, fn runs in the calling thread.
+
+    """
+    if concurrency <= 1:
+        for item in iterable:
+            yield fn(item)
+        return
+    pool = ThreadPool(concurrency)
+    pending = deque()
+    try:
+        for item in iterable:
+            pending.append(pool.apply_async(fn, (item,)))
+            if len(pending) >= concurrency:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+    finally:
+        pool.terminate()
+
+
+def retry(fn, transient, retries=AMAZON_RETRIES, backoff=AMAZON_RETRY_BACKOFF,
+          sleep=time.sleep):
+    """
+    Call fn until it succeeds, retrying up to retries times if it raises an
+    error for which transient(error) is true.
+
+    Retries wait with jittered exponential backoff: a random time of up to
+    backoff seconds before the first retry, doubling for each one after.
+
+    """
+    attempt = 0
+    while True:
+        try:
+            return fn()
+        except Exception as e:
+            if attempt >= retries or not transient(e):
+                raise
+            sleep(random.uniform(0, backoff * 2 ** attempt))
+            attempt += 1
+
+
+
+# pool shared by every asynchronous request, created on first use
+_pool = [None]
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    """
+    Return the process wide pool running asynchronous amazon requests.  Its
+    AMAZON_CONCURRENCY threads cap how many run at the same time.
+
+    """
+    if _pool[0] is None:
+        with _pool_lock:
+            if _pool[0] is None:
+                _pool[0] = ThreadPool(max(AMAZON_CONCURRENCY, 1))
+    return _pool[0]
+
+
+def set_pool(pool):
+    """Replace the shared pool, returning the previous one"""
+    with _pool_lock:
+        old, _pool[0] = _pool[0], pool
+    return old